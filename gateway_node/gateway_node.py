@@ -1,13 +1,27 @@
 from __future__ import annotations
 from raft.node.node import Node, NodeID
 from raft.node.follower import Follower
+from raft.log import is_read_only
 import logging
 from raft.utils.ms import send, reply
 import math
+from collections import deque
 from random import uniform, sample
 from typing import Any
-from threading import Timer
-from raft.config import HEARTBIT_RATE
+from raft.utils.event_loop import loop, TimerHandle
+from raft.config import (
+    QUORUM_READ_EXPLORE,
+    QUORUM_READ_HEDGE,
+    QUORUM_READ_TIMEOUT,
+    ROUTER_BACKLOG_SCALE,
+    ROUTER_MAX_FRACTION,
+    ROUTER_MIN_FRACTION,
+    ROUTER_STEP,
+    ROUTER_WEIGHT,
+)
+from raft.log_storage import open_storage
+from raft.utils.metrics import metrics
+from time import monotonic, perf_counter
 
 
 MsgID = int
@@ -38,13 +52,29 @@ class QuorumReadResponse:
 
 class QuorumReadState:
     _client_id: ClientID
+    _client_msg_id: MsgID
     _number_responses: int
     _most_updated_response: QuorumReadResponse
-
-    def __init__(self, client_id: ClientID, most_updated_response: QuorumReadResponse):
+    _started_at: float
+    # Peers asked that haven't responded yet
+    _waiting_for: set[NodeID]
+    # Replied to the client, the state is kept to time late responses
+    _done: bool
+
+    def __init__(
+        self,
+        client_id: ClientID,
+        client_msg_id: MsgID,
+        most_updated_response: QuorumReadResponse,
+        waiting_for: set[NodeID],
+    ):
         self._client_id = client_id
+        self._client_msg_id = client_msg_id
         self._number_responses = 1
         self._most_updated_response = most_updated_response
+        self._started_at = perf_counter()
+        self._waiting_for = waiting_for
+        self._done = False
 
     def update(self, response: QuorumReadResponse):
         if response.get_timestamp() > self._most_updated_response.get_timestamp():
@@ -58,29 +88,149 @@ class QuorumReadState:
     def get_most_updated(self):
         return self._most_updated_response
 
+    def get_started_at(self) -> float:
+        return self._started_at
+
+    def responded(self, node_id: NodeID) -> bool:
+        """
+        Whether the response of node_id is the first one it sent
+        """
+        if node_id not in self._waiting_for:
+            return False
+        self._waiting_for.remove(node_id)
+        return True
+
+    def get_waiting_for(self) -> set[NodeID]:
+        return self._waiting_for
+
+    def is_done(self) -> bool:
+        return self._done
+
+    def set_done(self) -> None:
+        self._done = True
+
+
+class ReadRouter:
+    """
+    Chooses between quorum and leaseholder reads. The share of quorum reads
+    moves towards the path that currently costs the least, from moving
+    averages of what each path is observed to cost.
+    """
+
+    _quorum_fraction: float
+    # Seconds, None until the first read of that kind completes
+    _quorum_latency: float | None
+    _leaseholder_latency: float | None
+    # Share of quorum reads that hit a pending write
+    _conflict_rate: float
+    # Share of leaseholder reads refused for lack of a lease
+    _failure_rate: float
+    # Callbacks queued on the leaseholder when it served the read
+    _backlog: float
+
+    def __init__(self, quorum_fraction: float):
+        self._quorum_fraction = quorum_fraction
+        self._quorum_latency = None
+        self._leaseholder_latency = None
+        self._conflict_rate = 0.0
+        self._failure_rate = 0.0
+        self._backlog = 0.0
+
+    def choose_quorum_read(self) -> bool:
+        return uniform(0, 1) <= self._quorum_fraction
+
+    def quorum_read_done(self, latency: float, has_conflict: bool) -> None:
+        self._quorum_latency = average(self._quorum_latency, latency)
+        self._conflict_rate = average(self._conflict_rate, float(has_conflict))
+        self.adapt()
+
+    def leaseholder_read_done(
+        self, latency: float, success: bool, backlog: int
+    ) -> None:
+        self._leaseholder_latency = average(self._leaseholder_latency, latency)
+        self._failure_rate = average(self._failure_rate, float(not success))
+        self._backlog = average(self._backlog, backlog)
+        self.adapt()
+
+    def quorum_cost(self) -> float:
+        # A conflicting read fails, the client has to retry it
+        return self._quorum_latency / (1 - min(self._conflict_rate, 0.9))
+
+    def leaseholder_cost(self) -> float:
+        # A refused read falls back to a quorum read
+        return (
+            self._leaseholder_latency * (1 + self._backlog / ROUTER_BACKLOG_SCALE)
+            + self._failure_rate * self.quorum_cost()
+        )
+
+    def adapt(self) -> None:
+        if self._quorum_latency is None or self._leaseholder_latency is None:
+            return
+
+        if self.quorum_cost() < self.leaseholder_cost():
+            fraction = self._quorum_fraction + ROUTER_STEP
+        else:
+            fraction = self._quorum_fraction - ROUTER_STEP
+        self._quorum_fraction = min(
+            max(fraction, ROUTER_MIN_FRACTION), ROUTER_MAX_FRACTION
+        )
+        metrics.gauge("read_router.quorum_fraction", self._quorum_fraction)
+
+
+def average(current: float | None, sample: float) -> float:
+    if current is None:
+        return sample
+    return current + ROUTER_WEIGHT * (sample - current)
+
 
 class GatewayNode:
     _raft_node: Node
     _node_id: NodeID
     _node_ids: list[NodeID]
-    _quorum_read_fraction: float
+    # Peers that take part in quorum reads, as in the Raft node's latest
+    # configuration, learners don't
+    _voter_ids: list[NodeID]
+    _router: ReadRouter
     _quorum_responses: dict[MsgID, QuorumReadState]
+    # Id of the last quorum read started by this gateway
+    _last_quorum_read_id: MsgID
+    # Deadline of each quorum read state, in the order they were created, as
+    # they all live for the same time
+    _quorum_deadlines: deque[tuple[float, MsgID]]
+    _expiry_timer: TimerHandle | None
+    # Moving average of the quorum read response time of each peer, seconds
+    _peer_latency: dict[NodeID, float]
+    # Reads of a learner not served yet, by read id, until their deadline
+    _index_reads: dict[MsgID, Any]
+    # Read index and read id of the learner reads waiting for the index to be
+    # applied
+    _fresh_reads: deque[tuple[int, MsgID]]
 
     def __init__(self, node_id: NodeID, node_ids: list[NodeID]):
         self._node_id = node_id
         self._node_ids = node_ids
         self._raft_node = Follower(node_id, node_ids)
-        self._quorum_read_fraction = self.compute_quorum_read_fraction()
+        self._raft_node.recover(open_storage(node_id))
+        self._voter_ids = self._raft_node.get_voter_ids()
+        self._router = ReadRouter(self.compute_quorum_read_fraction())
         self._quorum_responses = {}
+        self._last_quorum_read_id = 0
+        self._quorum_deadlines = deque()
+        self._expiry_timer = None
+        self._peer_latency = {}
+        self._index_reads = {}
+        self._fresh_reads = deque()
 
     def compute_quorum_read_fraction(self) -> float:
         # Current node id was already removed
-        n = len(self._node_ids) + 1
+        n = len(self._voter_ids) + 1
+        if n < 3:
+            return 1.0
         p = self.prob_included_majority()
         return 1 - ((p * (n - 2)) / (n + p * (n - 2)))
 
     def prob_included_majority(self) -> float:
-        n = len(self._node_ids) + 1
+        n = len(self._voter_ids) + 1
         if n == 3:
             return 1
         else:
@@ -89,27 +239,53 @@ class GatewayNode:
             )
 
     def compute_excluding_majority(self) -> int:
-        return math.ceil(len(self._node_ids) / 2)
+        return math.ceil(len(self._voter_ids) / 2)
 
     def handle(self, msg):
+        start = perf_counter()
         getattr(self, "handle_" + msg.body.type, self.handle_raft_message)(msg)
+        metrics.observe("handle." + msg.body.type, perf_counter() - start)
 
     def handle_raft_message(self, msg):
         self._raft_node = self._raft_node.handle(msg)
+        if self._raft_node.get_voter_ids() is not self._voter_ids:
+            self.membership_changed()
+        if self._fresh_reads:
+            self.serve_fresh_reads()
+
+    def membership_changed(self) -> None:
+        # The quorum read math depends on the number of voters
+        self._voter_ids = self._raft_node.get_voter_ids()
+        self._router = ReadRouter(self.compute_quorum_read_fraction())
+        for node_id in list(self._peer_latency):
+            if node_id not in self._voter_ids:
+                del self._peer_latency[node_id]
 
     def handle_read(self, msg) -> None:
-        if self.is_leaseholder():
+        if self._raft_node.is_learner():
+            self.read_at_index(msg)
+        elif self.is_leaseholder():
             if value := self._raft_node.direct_read(msg.body.key):
                 reply(msg, type="read_ok", value=value)
             else:
                 reply(msg, type="error", code=20, text="key not found")
         else:
-            chosen_value = uniform(0, 1)
-            if chosen_value <= self._quorum_read_fraction:
-                self.quorum_read(msg)
+            # A leader without a lease can't do better than a quorum read
+            if self._router.choose_quorum_read() or self._raft_node.is_leader():
+                self.quorum_read(msg.body.key, msg.src, msg.body.msg_id)
             else:
                 self.leaseholder_read(msg)
 
+    def handle_txn(self, msg) -> None:
+        # The whole txn is a single log entry, a leaseholder serves the ones
+        # that only read locally
+        if is_read_only(msg.body) and self._raft_node.is_learner():
+            self.read_at_index(msg)
+        elif is_read_only(msg.body) and self.is_leaseholder():
+            reply(msg, type="txn_ok", txn=self._raft_node.direct_txn(msg.body.txn))
+        else:
+            self.handle_raft_message(msg)
+
     def handle_quorum_read(self, msg) -> None:
         quorum_read_response = self.build_quorum_read_response(msg.body.key)
         reply(
@@ -122,25 +298,33 @@ class GatewayNode:
         )
 
     def handle_quorum_read_response(self, msg) -> None:
-        client_req_id = msg.body.client_req_id
-
-        if msg.body.client_req_id in self._quorum_responses:
-            quorum_read_state = self._quorum_responses[msg.body.client_req_id]
-            response = QuorumReadResponse(
-                msg.body.timestamp, msg.body.data, msg.body.has_conflict
+        quorum_read_state = self._quorum_responses.get(msg.body.client_req_id)
+        if quorum_read_state is None or not quorum_read_state.responded(msg.src):
+            return
+
+        elapsed = perf_counter() - quorum_read_state.get_started_at()
+        self._peer_latency[msg.src] = average(self._peer_latency.get(msg.src), elapsed)
+        if quorum_read_state.is_done():
+            # Hedged read that already completed
+            return
+
+        quorum_read_state.update(
+            QuorumReadResponse(msg.body.timestamp, msg.body.data, msg.body.has_conflict)
+        )
+        number_responses = quorum_read_state.get_number_responses()
+        if self.has_quorum_responses(number_responses):
+            metrics.observe("quorum_read.completion", elapsed)
+            self._router.quorum_read_done(
+                elapsed, quorum_read_state.get_most_updated().has_conflict()
             )
-            quorum_read_state.update(response)
-            number_responses = quorum_read_state.get_number_responses()
-            if self.has_quorum_responses(number_responses):
-                self.reply_to_client_read(client_req_id, quorum_read_state)
-                self._quorum_responses.pop(msg.body.client_req_id)
+            self.reply_to_client_read(quorum_read_state)
+            quorum_read_state.set_done()
 
     def has_quorum_responses(self, number_responses: int) -> bool:
         return number_responses > self.compute_excluding_majority()
 
-    def reply_to_client_read(
-        self, client_req_id: MsgID, quorum_read_state: QuorumReadState
-    ) -> None:
+    def reply_to_client_read(self, quorum_read_state: QuorumReadState) -> None:
+        client_req_id = quorum_read_state._client_msg_id
         most_updated_response = quorum_read_state.get_most_updated()
         if most_updated_response.has_conflict():
             send(
@@ -180,17 +364,25 @@ class GatewayNode:
                 value=self._raft_node.direct_read(msg.body.key),
                 client_id=msg.body.client_id,
                 client_req_id=msg.body.client_req_id,
+                sent_at=msg.body.sent_at,
+                backlog=loop.backlog(),
             )
         else:
             reply(
                 msg,
                 type="leaseholder_read_response",
                 success=False,
+                key=msg.body.key,
                 client_id=msg.body.client_id,
                 client_req_id=msg.body.client_req_id,
+                sent_at=msg.body.sent_at,
+                backlog=loop.backlog(),
             )
 
     def handle_leaseholder_read_response(self, msg) -> None:
+        self._router.leaseholder_read_done(
+            monotonic() - msg.body.sent_at, msg.body.success, msg.body.backlog
+        )
         if msg.body.success:
             if msg.body.value:
                 send(
@@ -210,17 +402,8 @@ class GatewayNode:
                     text="key not found",
                 )
         else:
-            send(
-                self._node_id,
-                msg.body.client_id,
-                in_reply_to=msg.body.client_req_id,
-                type="error",
-                code=11,
-                text="outdated leaseholder",
-            )
-
-    def handle_delete_quorum_state(self, msg) -> None:
-        self._quorum_responses.pop(msg.body.msg_id_to_delete, None)
+            # The leaseholder's lease lapsed, fall back to a quorum read
+            self.quorum_read(msg.body.key, msg.body.client_id, msg.body.client_req_id)
 
     def leaseholder_read(self, msg) -> None:
         if leaseholder_id := self.get_leasholder_id():
@@ -230,56 +413,168 @@ class GatewayNode:
                 type="leaseholder_read",
                 key=msg.body.key,
                 client_id=msg.src,
-                client_req_id=msg.id,
+                client_req_id=msg.body.msg_id,
+                sent_at=monotonic(),
             )
         else:
+            # No leader known, a quorum read doesn't need one
+            self.quorum_read(msg.body.key, msg.src, msg.body.msg_id)
+
+    # Learner reads: the leader confirms it still leads and returns its commit
+    # index, any read served once that index is applied is linearizable
+
+    def read_at_index(self, msg) -> None:
+        leader_id = self._raft_node.get_leader_id()
+        if leader_id is None:
+            reply(msg, type="error", code=11, text="no leader to check freshness")
+            return
+
+        self._last_quorum_read_id += 1
+        read_id = self._last_quorum_read_id
+        self._index_reads[read_id] = msg
+        send(
+            self._node_id,
+            leader_id,
+            type="read_index",
+            term=self._raft_node.get_current_term(),
+            read_id=read_id,
+        )
+        self.add_deadline(read_id)
+
+    def handle_read_index_response(self, msg) -> None:
+        read_id = msg.body.read_id
+        if read_id not in self._index_reads:
+            # Expired
+            return
+        if msg.body.index is None:
             reply(
-                msg,
+                self._index_reads.pop(read_id),
                 type="error",
                 code=11,
-                text="no leaseholder known",
+                text="no leader to check freshness",
             )
-
-    def quorum_read(self, msg) -> None:
-        # majority of all nodes, not counting with self
-        majority = self.compute_excluding_majority()
-        quorum = sample(self._node_ids, majority)
+            return
+
+        # Stays in _index_reads, so it still expires if the index is never
+        # applied
+        self._fresh_reads.append((msg.body.index, read_id))
+        self.serve_fresh_reads()
+
+    def serve_fresh_reads(self) -> None:
+        applied = self._raft_node.get_last_applied()
+        while self._fresh_reads and self._fresh_reads[0][0] <= applied:
+            _, read_id = self._fresh_reads.popleft()
+            if (read := self._index_reads.pop(read_id, None)) is None:
+                # Expired while waiting for the index to be applied
+                continue
+            metrics.increment("learner_reads")
+            if read.body.type == "txn":
+                txn = self._raft_node.direct_txn(read.body.txn)
+                reply(read, type="txn_ok", txn=txn)
+            elif value := self._raft_node.direct_read(read.body.key):
+                reply(read, type="read_ok", value=value)
+            else:
+                reply(read, type="error", code=20, text="key not found")
+
+    def quorum_read(self, key, client_id: ClientID, client_msg_id: MsgID) -> None:
+        self._last_quorum_read_id += 1
+        read_id = self._last_quorum_read_id
+        quorum = self.choose_quorum()
+        metrics.increment("quorum_read.started")
+        metrics.increment("quorum_read.fanout", len(quorum))
         for node_id in quorum:
             send(
                 self._node_id,
                 node_id,
                 type="quorum_read",
-                key=msg.body.key,
-                client_req_id=msg.id,
+                key=key,
+                client_req_id=read_id,
             )
-        my_quorum_response = self.build_quorum_read_response(msg.body.key)
-        self._quorum_responses[msg.id] = QuorumReadState(msg.src, my_quorum_response)
-        Timer(HEARTBIT_RATE * 2, lambda: self.delete_quorum_state(msg.id)).start()
-
-    def delete_quorum_state(self, msg_id: MsgID) -> None:
-        send(
-            self._node_id,
-            self._node_id,
-            type="delete_quorum_state",
-            msg_id_to_delete=msg_id,
+        my_quorum_response = self.build_quorum_read_response(key)
+        self._quorum_responses[read_id] = QuorumReadState(
+            client_id, client_msg_id, my_quorum_response, set(quorum)
         )
+        self.add_deadline(read_id)
 
-    def has_conflict(self, key) -> bool:
-        log = self._raft_node.get_log()
-        last_applied = self._raft_node.get_last_applied()
+    def add_deadline(self, read_id: MsgID) -> None:
+        self._quorum_deadlines.append((monotonic() + QUORUM_READ_TIMEOUT, read_id))
+        if self._expiry_timer is None:
+            self._expiry_timer = loop.call_later(
+                QUORUM_READ_TIMEOUT, self.expire_quorum_reads
+            )
+
+    def choose_quorum(self) -> list[NodeID]:
+        """
+        Peers to send a quorum read to, the fastest ones first
+        """
+        # majority of all nodes, not counting with self
+        size = min(
+            self.compute_excluding_majority() + QUORUM_READ_HEDGE, len(self._voter_ids)
+        )
+        if uniform(0, 1) < QUORUM_READ_EXPLORE:
+            return sample(self._voter_ids, size)
+        # Peers never measured are tried first
+        by_latency = sorted(
+            self._voter_ids, key=lambda node_id: self._peer_latency.get(node_id, 0)
+        )
+        return by_latency[:size]
+
+    def expire_quorum_reads(self) -> None:
+        """
+        Drop the state of every quorum read past its deadline, a single timer
+        is armed for the oldest one left
+        """
+        now = monotonic()
+        while self._quorum_deadlines and self._quorum_deadlines[0][0] <= now:
+            _, read_id = self._quorum_deadlines.popleft()
+            self.expire_quorum_read(read_id)
+
+        if self._quorum_deadlines:
+            self._expiry_timer = loop.call_later(
+                self._quorum_deadlines[0][0] - now, self.expire_quorum_reads
+            )
+        else:
+            self._expiry_timer = None
 
-        for entry in log[last_applied + 1 - 1 :]:
-            match entry.command.body.type:
-                case "write" | "cas":
-                    if key == entry.command.body.key:
-                        return True
-                case _:
-                    pass
+    def expire_quorum_read(self, read_id: MsgID) -> None:
+        if read_id in self._index_reads:
+            metrics.increment("learner_reads.timeouts")
+            reply(
+                self._index_reads.pop(read_id),
+                type="error",
+                code=0,
+                text="learner read timed out",
+            )
+            return
+        state = self._quorum_responses.pop(read_id, None)
+        if state is None:
+            # Learner read that was served in time
+            return
+
+        elapsed = perf_counter() - state.get_started_at()
+        # Peers that didn't respond in time are at least this slow
+        for node_id in state.get_waiting_for():
+            self._peer_latency[node_id] = average(
+                self._peer_latency.get(node_id), elapsed
+            )
+        if not state.is_done():
+            # Timed out, a cost the router has to know about
+            self._router.quorum_read_done(elapsed, False)
+            metrics.increment("quorum_read.timeouts")
+            send(
+                self._node_id,
+                state._client_id,
+                in_reply_to=state._client_msg_id,
+                type="error",
+                code=0,
+                text="quorum read timed out",
+            )
 
-        return False
+    def has_conflict(self, key) -> bool:
+        return self._raft_node.has_pending_write(key)
 
     def is_leaseholder(self) -> bool:
-        return self._raft_node.is_leader()
+        return self._raft_node.has_lease()
 
     def get_leasholder_id(self) -> NodeID | None:
         return self._raft_node.get_leader_id()
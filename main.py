@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
+import atexit
 import logging
-from raft.utils.ms import receive_all, reply, exit_on_error
-from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from raft.utils.ms import run, reply, exit_on_error
+from raft.utils.metrics import metrics
 from gateway_node.gateway_node import GatewayNode
+from raft.multi_raft import MultiRaft
+from raft.config import SHARDS
 
 
 logging.getLogger().setLevel(logging.DEBUG)
-executor = ThreadPoolExecutor(max_workers=1)
+atexit.register(metrics.dump)
 
-node: GatewayNode
+node: GatewayNode | MultiRaft
 
 
 def handle_init(msg):
@@ -22,7 +26,10 @@ def handle_init(msg):
     node_id = msg.body.node_id
     node_ids = msg.body.node_ids
     node_ids.remove(node_id)
-    node = GatewayNode(node_id, node_ids)
+    if SHARDS > 1:
+        node = MultiRaft(node_id, node_ids, GatewayNode)
+    else:
+        node = GatewayNode(node_id, node_ids)
 
     logging.info("node %s initialized", node_id)
 
@@ -37,4 +44,4 @@ def handle_rest(msg):
 
 
 handler = handle_init
-executor.map(lambda msg: exit_on_error(handler, msg), receive_all())
+run(lambda msg: exit_on_error(handler, msg))
@@ -1,3 +1,79 @@
-HEARTBIT_RATE = 1
+HEARTBIT_RATE = 0.5
 LOWER_TIMEOUT = 1
 UPPER_TIMEOUT = 2
+
+# Leader lease: a leader acked by a majority at time t can serve reads locally
+# until t + LEASE_DURATION. Followers don't vote during LOWER_TIMEOUT after
+# hearing from the leader, so the lease is safe while clocks advance at rates
+# that differ by less than MAX_CLOCK_DRIFT.
+MAX_CLOCK_DRIFT = 0.1
+LEASE_DURATION = LOWER_TIMEOUT / (1 + MAX_CLOCK_DRIFT)
+
+# Leader write batching: client ops are grouped and replicated in a single
+# AppendEntries round once BATCH_MAX_ENTRIES are pending or BATCH_MAX_DELAY
+# seconds have passed since the first one. BATCH_MAX_ENTRIES = 1 disables it.
+BATCH_MAX_ENTRIES = 32
+BATCH_MAX_DELAY = 0.002
+
+# Followers forward client ops to the leader they know, grouped in batches
+# bounded like the leader's, and relay the replies. Reads are only forwarded
+# when FORWARD_READS is set, otherwise they are refused as before.
+FORWARD_READS = True
+
+# Bounds of a single AppendEntries RPC and number of them that may be in
+# flight to each follower at the same time
+APPEND_ENTRIES_MAX_ENTRIES = 64
+APPEND_ENTRIES_MAX_BYTES = 64 * 1024
+APPEND_ENTRIES_WINDOW = 4
+
+# Committed entries are applied apart from replication, at most
+# APPLY_BATCH_ENTRIES at a time so acks are handled between batches
+APPLY_BATCH_ENTRIES = 256
+
+# Client sessions: the response to the last request of each client is kept
+# in the replicated state so a retry is answered without appending it again.
+# Only the SESSION_MAX_CLIENTS most recently active clients are tracked.
+SESSION_MAX_CLIENTS = 1000
+
+# Learners: nodes that replicate and apply the log, and serve reads after
+# checking their freshness with the leader, but never vote nor count towards
+# a commit, read or lease majority
+LEARNERS: frozenset[str] = frozenset()
+
+# Number of applied entries kept in the log before it is compacted into a
+# snapshot of the store
+SNAPSHOT_THRESHOLD = 1000
+
+# Directory where each node persists its log, under a subdirectory named
+# after the node. None keeps everything in memory, a restarted node then
+# rebuilds its state from the leader.
+DATA_DIR: str | None = None
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+
+# Adaptive read routing: gateways start from the analytical quorum read
+# fraction and move it by ROUTER_STEP towards the path with the lowest
+# estimated cost, an exponential moving average with weight ROUTER_WEIGHT of
+# its latency inflated by quorum conflicts, leaseholder failures and the
+# leaseholder backlog. The fraction stays within the bounds so both paths
+# keep being measured.
+ROUTER_WEIGHT = 0.1
+ROUTER_STEP = 0.01
+ROUTER_MIN_FRACTION = 0.05
+ROUTER_MAX_FRACTION = 0.95
+# Leaseholder backlog that doubles the estimated cost of a leaseholder read
+ROUTER_BACKLOG_SCALE = 64
+
+# Quorum reads not answered by a majority within QUORUM_READ_TIMEOUT fail with
+# a timeout error. They go to the peers with the lowest response latency, plus
+# QUORUM_READ_HEDGE more so a slow one doesn't stall the read, which completes
+# on the first majority of responses. A share QUORUM_READ_EXPLORE of reads
+# goes to random peers instead, to keep measuring the ones not picked.
+QUORUM_READ_TIMEOUT = HEARTBIT_RATE * 2
+QUORUM_READ_HEDGE = 1
+QUORUM_READ_EXPLORE = 0.05
+
+# Multi-Raft: keys are hash partitioned between SHARDS independent Raft
+# groups, each with its own term, log and leader. Group g of node n1 is
+# addressed as n1:g. A single group runs without any of it.
+SHARDS = 1
+SHARD_SEPARATOR = ":"
@@ -1,14 +1,91 @@
+from collections import OrderedDict
 from typing import Any
+from raft.config import SESSION_MAX_CLIENTS
 
 
 class KeyValueStore:
     _store: dict[Any, Any]
+    # Last request id applied for each client and the response to it, least
+    # recently used first. Every replica applies the same entries in the same
+    # order, so they all evict the same sessions.
+    _sessions: OrderedDict[str, tuple[int, dict]]
 
     def __init__(self) -> None:
         self._store = {}
+        self._sessions = OrderedDict()
 
     def write(self, key: Any, value: Any) -> None:
         self._store[key] = value
 
     def read(self, key: Any) -> Any | None:
         return self._store.get(key)
+
+    def transact(self, ops: list[list]) -> list[list] | None:
+        """
+        Apply the micro-ops of a transaction, ["r", key, None], ["w", key,
+        value] or ["cas", key, from, to], all together. Returns them with the
+        values read filled in, or None without writing anything if a cas
+        doesn't match.
+        """
+        written: dict[Any, Any] = {}
+        result = []
+        for op in ops:
+            key = op[1]
+            current = written[key] if key in written else self._store.get(key)
+            match op[0]:
+                case "r":
+                    result.append(["r", key, current])
+                case "w":
+                    written[key] = op[2]
+                    result.append(op)
+                case "cas":
+                    if current is None or current != op[2]:
+                        return None
+                    written[key] = op[3]
+                    result.append(op)
+
+        self._store.update(written)
+        return result
+
+    def is_applied(self, client_id: str, request_id: int) -> bool:
+        """
+        Whether a request was already applied. Request ids grow for each
+        client, so every id up to the last one applied was.
+        """
+        session = self._sessions.get(client_id)
+        return session is not None and request_id <= session[0]
+
+    def session_response(self, client_id: str, request_id: int) -> dict | None:
+        """
+        Response to the last request applied for the client, None for any
+        other request
+        """
+        session = self._sessions.get(client_id)
+        if session is not None and session[0] == request_id:
+            return session[1]
+        return None
+
+    def save_session(self, client_id: str, request_id: int, response: dict) -> None:
+        # Clients have a single request outstanding, a new one means the
+        # previous response was received
+        self._sessions[client_id] = (request_id, response)
+        self._sessions.move_to_end(client_id)
+        if len(self._sessions) > SESSION_MAX_CLIENTS:
+            self._sessions.popitem(last=False)
+
+    def snapshot(self) -> dict[str, list]:
+        # Pairs instead of a dict, keys don't have to be strings in JSON
+        return {
+            "pairs": list(self._store.items()),
+            "sessions": [
+                [client_id, request_id, response]
+                for client_id, (request_id, response) in self._sessions.items()
+            ],
+        }
+
+    def restore(self, snapshot: dict[str, list]) -> None:
+        self._store = {key: value for key, value in snapshot["pairs"]}
+        self._sessions = OrderedDict(
+            (client_id, (request_id, response))
+            for client_id, request_id, response in snapshot["sessions"]
+        )
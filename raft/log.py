@@ -0,0 +1,158 @@
+from __future__ import annotations
+from array import array
+from typing import Any
+
+# An entry as it is replicated and stored: [term, type, key, *arguments],
+# followed by the client and request id of the ops that have a session
+Record = list
+# Number of arguments of each type of command
+ARGUMENTS = {"read": 0, "write": 1, "cas": 2, "txn": 1, "config": 1, "noop": 0}
+
+
+class Command:
+    """
+    Key value store operation of a log entry, without the client message.
+    A txn has no key, its value is the list of its micro-ops. A config has
+    no key either, its value is the list of voting members. Ops that change
+    the store carry the client and request id of their session.
+    """
+
+    __slots__ = ("type", "key", "value", "from_", "to", "session")
+    type: str
+    key: Any
+    value: Any
+    from_: Any
+    to: Any
+    session: tuple[str, int] | None
+
+    def __init__(
+        self, type: str, key: Any, value=None, from_=None, to=None, session=None
+    ) -> None:
+        self.type = type
+        self.key = key
+        self.value = value
+        self.from_ = from_
+        self.to = to
+        self.session = session
+
+    @classmethod
+    def from_request(cls, body, session: tuple[str, int] | None = None) -> Command:
+        match body.type:
+            case "write":
+                return cls(body.type, body.key, value=body.value, session=session)
+            case "cas":
+                return cls(
+                    body.type,
+                    body.key,
+                    from_=getattr(body, "from"),
+                    to=body.to,
+                    session=session,
+                )
+            case "txn":
+                return cls(body.type, None, value=body.txn, session=session)
+            case _:
+                return cls(body.type, body.key)
+
+    @classmethod
+    def from_record(cls, record: Record) -> Command:
+        end = 3 + ARGUMENTS[record[1]]
+        session = tuple(record[end:]) if len(record) > end else None
+        match record[1]:
+            case "write" | "txn" | "config":
+                return cls(record[1], record[2], value=record[3], session=session)
+            case "cas":
+                return cls(
+                    record[1], record[2], from_=record[3], to=record[4], session=session
+                )
+            case _:
+                return cls(record[1], record[2])
+
+    def written_keys(self) -> tuple:
+        match self.type:
+            case "write" | "cas":
+                return (self.key,)
+            case "txn":
+                keys = (op[1] for op in self.value if op[0] != "r")
+                return tuple(dict.fromkeys(keys))
+            case _:
+                return ()
+
+    def to_record(self, term: int) -> Record:
+        match self.type:
+            case "write" | "txn" | "config":
+                record = [term, self.type, self.key, self.value]
+            case "cas":
+                record = [term, self.type, self.key, self.from_, self.to]
+            case _:
+                record = [term, self.type, self.key]
+        if self.session is not None:
+            record.extend(self.session)
+        return record
+
+
+def is_read_only(body) -> bool:
+    """
+    Whether a client request only reads, a read or a txn of reads only
+    """
+    match body.type:
+        case "read":
+            return True
+        case "txn":
+            return all(op[0] == "r" for op in body.txn)
+        case _:
+            return False
+
+
+class RaftLog:
+    """
+    Entries that follow the snapshot, addressed by their position. Terms are
+    kept in a typed array apart from the commands, as most log checks only
+    need the terms.
+    """
+
+    _terms: array
+    _commands: list[Command]
+
+    def __init__(self) -> None:
+        self._terms = array("q")
+        self._commands = []
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def append(self, term: int, command: Command) -> None:
+        self._terms.append(term)
+        self._commands.append(command)
+
+    def extend(self, records: list[Record]) -> None:
+        for record in records:
+            self.append(record[0], Command.from_record(record))
+
+    def term(self, position: int) -> int:
+        return self._terms[position]
+
+    def command(self, position: int) -> Command:
+        return self._commands[position]
+
+    def commands(self, start: int, stop: int | None = None) -> list[Command]:
+        return self._commands[start:stop]
+
+    def records(self, start: int, stop: int) -> list[Record]:
+        return [
+            command.to_record(term)
+            for term, command in zip(self._terms[start:stop], self._commands[start:stop])
+        ]
+
+    def truncate(self, position: int) -> None:
+        """
+        Drop the entries from position onwards
+        """
+        del self._terms[position:]
+        del self._commands[position:]
+
+    def drop(self, count: int) -> None:
+        """
+        Drop the first count entries
+        """
+        del self._terms[:count]
+        del self._commands[:count]
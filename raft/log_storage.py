@@ -0,0 +1,230 @@
+from __future__ import annotations
+import logging
+import mmap
+import os
+import struct
+from json import dumps, loads
+from typing import Any
+from zlib import crc32
+from raft.config import DATA_DIR, SEGMENT_MAX_BYTES
+
+# Record header: crc32, payload length, kind, index, term
+_HEADER = struct.Struct("<IIBQQ")
+_ENTRY = 1
+# Drops every entry starting at the record's index
+_TRUNCATE = 2
+
+
+class LogStorage:
+    """
+    Storage of the Raft persistent state. This base class keeps nothing, it
+    is used when persistence is disabled.
+    """
+
+    def save_state(self, term: int, voted_for: str | None) -> None:
+        pass
+
+    def append(self, first_index: int, records: list) -> None:
+        pass
+
+    def truncate(self, first_index: int) -> None:
+        pass
+
+    def sync(self) -> None:
+        pass
+
+    def save_snapshot(self, index: int, term: int, data: dict) -> None:
+        pass
+
+    def load(self) -> tuple[dict, dict | None, list]:
+        """
+        Hard state, snapshot and the records of the entries that follow the
+        snapshot
+        """
+        return {"term": 0, "voted_for": None}, None, []
+
+
+class SegmentedLogStorage(LogStorage):
+    """
+    Append-only segment files of binary records. Appends are only written,
+    a single sync makes everything appended since the previous one durable.
+    """
+
+    _path: str
+    _state: dict
+    _segments: list[tuple[str, int]]  # path and highest index written to it
+    _file: Any
+    _size: int
+    _dirty: bool
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        self._state = {"term": 0, "voted_for": None}
+        self._segments = []
+        self._file = None
+        self._size = 0
+        self._dirty = False
+
+    # Hard state and snapshot, small files replaced atomically
+
+    def save_state(self, term: int, voted_for: str | None) -> None:
+        state = {"term": term, "voted_for": voted_for}
+        if state != self._state:
+            self._state = state
+            self._write_atomically("state", dumps(state).encode())
+
+    def save_snapshot(self, index: int, term: int, data: dict) -> None:
+        snapshot = {"index": index, "term": term, "data": data}
+        self._write_atomically("snapshot", dumps(snapshot).encode())
+        self.compact(index)
+
+    def _write_atomically(self, name: str, data: bytes) -> None:
+        tmp = os.path.join(self._path, name + ".tmp")
+        with open(tmp, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, os.path.join(self._path, name))
+        # The rename itself is only durable once the directory is
+        self._sync_directory()
+
+    def _sync_directory(self) -> None:
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read_json(self, name: str) -> Any | None:
+        try:
+            with open(os.path.join(self._path, name), "rb") as file:
+                return loads(file.read())
+        except FileNotFoundError:
+            return None
+
+    # Segments
+
+    def append(self, first_index: int, records: list) -> None:
+        for index, record in enumerate(records, first_index):
+            payload = dumps(record[1:]).encode()
+            self._write_record(_ENTRY, index, record[0], payload)
+
+    def truncate(self, first_index: int) -> None:
+        self._write_record(_TRUNCATE, first_index, 0, b"")
+
+    def _write_record(self, kind: int, index: int, term: int, payload: bytes) -> None:
+        if self._file is None:
+            self._open_segment()
+
+        header = _HEADER.pack(0, len(payload), kind, index, term)
+        crc = crc32(payload, crc32(header[4:]))
+        self._file.write(_HEADER.pack(crc, len(payload), kind, index, term))
+        self._file.write(payload)
+        self._size += _HEADER.size + len(payload)
+        path, last_index = self._segments[-1]
+        self._segments[-1] = (path, max(last_index, index))
+        self._dirty = True
+
+    def sync(self) -> None:
+        """
+        Group commit, a single fsync for every record written since the last one
+        """
+        if not self._dirty:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+        if self._size >= SEGMENT_MAX_BYTES:
+            self._file.close()
+            self._file = None
+
+    def _open_segment(self) -> None:
+        sequence = 1
+        if self._segments:
+            sequence = int(os.path.basename(self._segments[-1][0])[:-4]) + 1
+        path = os.path.join(self._path, f"{sequence:08d}.wal")
+        self._file = open(path, "ab")
+        # Entries synced to the new segment would be lost with its entry
+        self._sync_directory()
+        self._size = 0
+        self._segments.append((path, 0))
+
+    def compact(self, snapshot_index: int) -> None:
+        """
+        Delete the oldest closed segments, once the snapshot covers them
+        """
+        closed = len(self._segments) - (1 if self._file is not None else 0)
+        deleted = 0
+        while deleted < closed and self._segments[deleted][1] <= snapshot_index:
+            os.remove(self._segments[deleted][0])
+            deleted += 1
+        del self._segments[:deleted]
+
+    # Recovery
+
+    def load(self) -> tuple[dict, dict | None, list]:
+        state = self._read_json("state") or self._state
+        self._state = state
+        snapshot = self._read_json("snapshot")
+        snapshot_index = snapshot["index"] if snapshot else 0
+
+        entries: list = []
+        paths = sorted(
+            os.path.join(self._path, name)
+            for name in os.listdir(self._path)
+            if name.endswith(".wal")
+        )
+        for position, path in enumerate(paths):
+            last_index, valid = self._replay(path, snapshot_index, entries)
+            self._segments.append((path, last_index))
+            if not valid:
+                # Torn write of the last sync, anything after it was never acked
+                for later in paths[position + 1 :]:
+                    os.remove(later)
+                break
+
+        return state, snapshot, entries
+
+    def _replay(
+        self, path: str, snapshot_index: int, entries: list
+    ) -> tuple[int, bool]:
+        last_index = 0
+        with open(path, "r+b") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return last_index, True
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + _HEADER.size <= size:
+                    crc, length, kind, index, term = _HEADER.unpack_from(data, offset)
+                    end = offset + _HEADER.size + length
+                    if end > size or crc != crc32(
+                        data[offset + _HEADER.size : end],
+                        crc32(data[offset + 4 : offset + _HEADER.size]),
+                    ):
+                        break
+
+                    last_index = max(last_index, index)
+                    if index > snapshot_index:
+                        del entries[index - snapshot_index - 1 :]
+                        if kind == _ENTRY:
+                            payload = loads(data[offset + _HEADER.size : end])
+                            entries.append([term, *payload])
+                    offset = end
+
+            if offset < size:
+                logging.warning("discarding torn tail of %s at %d", path, offset)
+                file.truncate(offset)
+                return last_index, False
+
+        return last_index, True
+
+
+def open_storage(node_id: str) -> LogStorage:
+    if DATA_DIR is None:
+        return LogStorage()
+    return SegmentedLogStorage(os.path.join(DATA_DIR, node_id))
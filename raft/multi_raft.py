@@ -0,0 +1,147 @@
+# Multi-Raft: independent Raft groups sharing a process and its connections
+
+from __future__ import annotations
+from json import dumps
+from typing import Any, Callable
+from zlib import crc32
+from raft.node.node import NodeID
+from raft.utils.codec import Message, decode_body
+from raft.utils.event_loop import loop
+from raft.utils.ms import post, reply, send, set_route, write
+from raft.utils.metrics import metrics
+from raft.config import LOWER_TIMEOUT, SHARDS, SHARD_SEPARATOR
+
+
+def shard_id(node_id: NodeID, shard: int) -> NodeID:
+    return f"{node_id}{SHARD_SEPARATOR}{shard}"
+
+
+def shard_of_key(key: Any) -> int:
+    # Python's hash of a string differs between processes
+    return crc32(dumps(key).encode()) % SHARDS
+
+
+class MultiRaft:
+    """
+    Runs SHARDS Raft groups, a Raft node or a gateway each, over the keys
+    partitioned between them. Messages from the groups of this node to the
+    groups of another one are sent together in a single multi message.
+    """
+
+    _node_id: NodeID
+    _node_ids: list[NodeID]
+    _shards: list[Any]
+    # Messages waiting to be sent to each node
+    _outbox: dict[NodeID, list[dict]]
+
+    def __init__(
+        self,
+        node_id: NodeID,
+        node_ids: list[NodeID],
+        new_shard: Callable[[NodeID, list[NodeID]], Any],
+    ) -> None:
+        self._node_id = node_id
+        self._node_ids = node_ids
+        self._shards = [
+            new_shard(
+                shard_id(node_id, shard),
+                [shard_id(peer, shard) for peer in node_ids],
+            )
+            for shard in range(SHARDS)
+        ]
+        self._outbox = {}
+        set_route(self.route)
+        self.spread_leaders()
+
+    def spread_leaders(self) -> None:
+        """
+        Each node campaigns first for its share of the groups, before most
+        election timeouts fire, so the leaders start spread over the cluster
+        """
+        members = sorted([self._node_id] + self._node_ids)
+        for shard in range(SHARDS):
+            if members[shard % len(members)] == self._node_id:
+                # Nodes refuse votes during LOWER_TIMEOUT after they start
+                loop.call_later(LOWER_TIMEOUT * 1.1, self.campaign, shard)
+
+    def campaign(self, shard: int) -> None:
+        post(shard_id(self._node_id, shard), type="campaign")
+
+    # Incoming messages
+
+    def handle(self, msg) -> MultiRaft:
+        if msg.body.type == "multi":
+            for message in msg.body.messages:
+                self.dispatch(
+                    Message(
+                        None,
+                        message["src"],
+                        message["dest"],
+                        decode_body(message["body"]),
+                    )
+                )
+        elif SHARD_SEPARATOR in msg.dest:
+            # Posted by a group to itself
+            self.dispatch(msg)
+        elif (shard := self.shard_of(msg.body)) is None:
+            reply(
+                msg,
+                type="error",
+                code=10,
+                text="txn keys are in different shards",
+            )
+        else:
+            msg.dest = shard_id(self._node_id, shard)
+            if msg.body.type == "transfer_leadership" and msg.body.target is not None:
+                msg.body.target = shard_id(msg.body.target, shard)
+            if msg.body.type == "change_membership":
+                # Members are named by node, each group is changed on its own
+                for field in ("add", "remove"):
+                    if (node := getattr(msg.body, field)) is not None:
+                        setattr(msg.body, field, shard_id(node, shard))
+            self.dispatch(msg)
+
+        return self
+
+    def dispatch(self, msg) -> None:
+        shard = int(msg.dest.rsplit(SHARD_SEPARATOR, 1)[1])
+        # Raft nodes return their next state, gateways update themselves
+        if (next_state := self._shards[shard].handle(msg)) is not None:
+            self._shards[shard] = next_state
+
+    def shard_of(self, body) -> int | None:
+        """
+        Group of the keys of a client request, None if they span several
+        """
+        match body.type:
+            case "read" | "write" | "cas":
+                return shard_of_key(body.key)
+            case "txn":
+                shards = {shard_of_key(op[1]) for op in body.txn}
+                return shards.pop() if len(shards) == 1 else None
+            case "transfer_leadership" | "change_membership":
+                return body.shard or 0
+            case _:
+                return 0
+
+    # Outgoing messages
+
+    def route(self, message: dict) -> None:
+        dest = message["dest"]
+        if SHARD_SEPARATOR not in dest:
+            # Clients only know this node by its own id
+            message["src"] = self._node_id
+            write(message)
+            return
+
+        if not self._outbox:
+            loop.call_soon(self.flush)
+        node_id = dest.rsplit(SHARD_SEPARATOR, 1)[0]
+        self._outbox.setdefault(node_id, []).append(message)
+
+    def flush(self) -> None:
+        outbox, self._outbox = self._outbox, {}
+        for node_id, messages in outbox.items():
+            send(self._node_id, node_id, type="multi", messages=messages)
+            metrics.increment("multi.sent")
+            metrics.increment("multi.messages", len(messages))
@@ -2,16 +2,17 @@ from __future__ import annotations
 import logging
 from raft.node.node import Node, NodeID
 from raft.config import LOWER_TIMEOUT, UPPER_TIMEOUT
-from math import ceil
 from raft.node.leader import Leader
 from raft.utils.random_timer import RandomTimer
-from raft.utils.ms import send
+from raft.utils.ms import send, post
+from raft.utils.metrics import metrics
 
 
 class Candidate(Node):
 
     _voters: set[NodeID]
-    _majority: int
+    # Started by the leader, voters don't wait for the leader to time out
+    _leadership_transfer: bool = False
 
     def __init__(self, node_id: NodeID, node_ids: list[NodeID]) -> None:
         super().__init__(node_id, node_ids)
@@ -19,34 +20,42 @@ class Candidate(Node):
         self._timer.start()
         self._voters = set()
         self._voters.add(self._node_id)
-        self._majority = ceil(len(node_ids) / 2)
 
         self._voted_for = node_id
 
     @classmethod
-    def transition_from(cls, node: Node) -> Candidate:
+    def transition_from(
+        cls, node: Node, leadership_transfer=False
+    ) -> Candidate | Leader:
         logging.info(f"Transitioning from {node} to Candidate")
+        metrics.increment("elections.started")
         new_state: Candidate = super().transition_from(node)
+        new_state._leadership_transfer = leadership_transfer
         new_state._current_term += 1
+        new_state._voted_for = new_state._node_id
+        new_state.persist_state()
         new_state.request_vote()
-        return new_state
+        # A single voter has its majority already
+        return new_state.check_if_can_became_leader()
 
     def request_vote(self) -> None:
-        log_size = len(self._log)
-        last_log_term = self._current_term if log_size == 0 else self._log[-1].term
-        for dest_id in self._node_ids:
+        last_log_index = self.last_log_index()
+        last_log_term = self.last_log_term()
+        for dest_id in self._voter_ids:
             send(
                 self._node_id,
                 dest_id,
                 type="request_vote",
                 term=self._current_term,
                 candidate_id=self._node_id,
-                last_log_index=log_size,
+                last_log_index=last_log_index,
                 last_log_term=last_log_term,
+                leadership_transfer=self._leadership_transfer,
             )
 
     def check_if_can_became_leader(self) -> Leader | Candidate:
-        if len(self._voters) >= self._majority:
+        # Against the latest configuration, it may change during the election
+        if len(self._voters) >= self.majority():
             return Leader.transition_from(self)
         return self
 
@@ -62,8 +71,11 @@ class Candidate(Node):
 
         return self.check_if_can_became_leader()
 
-    def handle_new_election(self, msg) -> Candidate:
-        return Candidate.transition_from(self)
+    def handle_new_election(self, msg) -> Follower | Candidate | Leader:
+        # Another term is only started once a pre-vote shows it can be won
+        from raft.node.follower import Follower
+
+        return Follower.transition_from(self).start_pre_vote()
 
     def start_new_election(self) -> None:
-        send(self._node_id, self._node_id, type="new_election")
+        post(self._node_id, type="new_election")
@@ -1,74 +1,320 @@
 from __future__ import annotations
 from raft.node.candidate import Candidate
+from raft.node.leader import Leader
 import logging
 from raft.node.node import Node, NodeID
-from raft.utils.ms import reply, send
+from raft.log import Record, is_read_only
+from raft.log_storage import LogStorage
+from raft.utils.ms import reply, post, send, send_all
+from raft.utils.event_loop import loop, TimerHandle
 from raft.utils.random_timer import RandomTimer
-from raft.config import LOWER_TIMEOUT, UPPER_TIMEOUT
+from raft.utils.metrics import metrics
+from raft.config import (
+    LOWER_TIMEOUT,
+    UPPER_TIMEOUT,
+    BATCH_MAX_ENTRIES,
+    BATCH_MAX_DELAY,
+    FORWARD_READS,
+)
+from time import monotonic
 
 
 class Follower(Node):
     _timer: RandomTimer
     _leader_id: NodeID | None
+    # When an AppendEntries was last received, no vote is granted during
+    # LOWER_TIMEOUT after it as the leader may hold a lease
+    _leader_contact_at: float
+    # Client ops waiting to be forwarded to the leader, with their client
+    _forward_batch: list[dict]
+    _forward_timer: TimerHandle | None
+    # Nodes that granted the pre-vote in progress, None when there is none
+    _pre_votes: set[NodeID] | None
 
     def __init__(self, node_id: NodeID, node_ids: list[NodeID]) -> None:
         super().__init__(node_id, node_ids)
         self._timer = RandomTimer(LOWER_TIMEOUT, UPPER_TIMEOUT, self.handle_timeout)
         self._timer.start()
         self._leader_id = None
+        self._leader_contact_at = float("-inf")
+        self._forward_batch = []
+        self._forward_timer = None
+        self._pre_votes = None
         logging.info("init follower")
 
     @classmethod
     def transition_from(cls, node: Node) -> Follower:
         logging.info(f"Transitioning from {node} to Follower")
-        return super().transition_from(node)
+        new_state: Follower = super().transition_from(node)
+        if isinstance(node, Follower):
+            new_state._leader_contact_at = node._leader_contact_at
+        return new_state
+
+    def recover(self, storage: LogStorage) -> None:
+        super().recover(storage)
+        # A leader may still count an ack this node sent before it restarted,
+        # wait as if it had just heard from it before granting any vote
+        self._leader_contact_at = monotonic()
+
+    def stop_timers(self) -> None:
+        super().stop_timers()
+        # The leader that was known may still take them
+        if self._forward_batch:
+            self.forward_batch()
 
     def handle_timeout(self) -> None:
-        send(self._node_id, self._node_id, type="turn_candidate")
+        post(self._node_id, type="turn_candidate")
 
     def handle_append_entries(self, msg) -> Follower:
+        # 1 . Older term
+        if msg.body.term < self._current_term:
+            # A deposed leader, it must not look like the current one
+            self.reject_append_entries(msg)
+            return self
+
         self._timer.reset()
+        self._pre_votes = None
         self._leader_id = msg.body.leader_id
+        self._leader_contact_at = monotonic()
 
-        # 1 . Older term &&
         # 2. Log doesn't contain entry at prev_log_index which matches prev term
-        if msg.body.term < self._current_term or not self.log_contains(
-            msg.body.prev_log_index, msg.body.prev_log_term
-        ):
-            reply(
-                msg,
-                type="append_entries_response",
-                term=self._current_term,
-                success=False,
-            )
+        if not self.log_contains(msg.body.prev_log_index, msg.body.prev_log_term):
+            self.reject_append_entries(msg)
         else:
             # 3. Delete conflicting entry and all that follow it
             # &&
             # 4. Append any new entries not already in the log
-            self._log[msg.body.prev_log_index :] = msg.body.entries
+            self.merge_entries(msg.body.prev_log_index, msg.body.entries)
+            # The entries must be durable before they are acknowledged
+            self._storage.sync()
+            last_new_index = msg.body.prev_log_index + len(msg.body.entries)
 
             # 5. If leader commit > commit index, set commit index to min(leader commit, index of last new entry)
             if msg.body.leader_commit > self._commit_index:
-                self._commit_index = min(msg.body.leader_commit, len(self._log))
-                self.apply()
+                self._commit_index = max(
+                    self._commit_index, min(msg.body.leader_commit, last_new_index)
+                )
+                self.schedule_apply()
 
             reply(
                 msg,
                 type="append_entries_response",
                 term=self._current_term,
                 success=True,
-                last_index=len(self._log),
+                read_round=msg.body.read_round,
+                sent_at=msg.body.sent_at,
+                entry_count=len(msg.body.entries),
+                last_index=last_new_index,
             )
 
         return self
 
+    def reject_append_entries(self, msg) -> None:
+        reply(
+            msg,
+            type="append_entries_response",
+            term=self._current_term,
+            success=False,
+            read_round=msg.body.read_round,
+            sent_at=msg.body.sent_at,
+            entry_count=len(msg.body.entries),
+            prev_log_index=msg.body.prev_log_index,
+            **self.conflict_hint(msg.body.prev_log_index),
+        )
+
+    def handle_install_snapshot(self, msg) -> Follower:
+        self._timer.reset()
+
+        if msg.body.term < self._current_term:
+            reply(
+                msg,
+                type="install_snapshot_response",
+                term=self._current_term,
+                last_index=0,
+            )
+            return self
+
+        self._leader_id = msg.body.leader_id
+        if msg.body.last_included_index > self._last_applied:
+            self.install_snapshot(
+                msg.body.last_included_index,
+                msg.body.last_included_term,
+                msg.body.data,
+            )
+
+        reply(
+            msg,
+            type="install_snapshot_response",
+            term=self._current_term,
+            last_index=msg.body.last_included_index,
+        )
+        return self
+
+    def conflict_hint(self, prev_log_index: int) -> dict:
+        """
+        Tell the leader where the logs diverge, so it can skip over a whole
+        conflicting term instead of backtracking one entry at a time.
+        """
+        if prev_log_index > self.last_log_index():
+            # Missing entries, the leader can resume right after our last one
+            return {"conflict_term": 0, "conflict_index": self.last_log_index() + 1}
+        if prev_log_index <= self._snapshot_index:
+            # Rejected for a stale term, the entries up to the snapshot are
+            # compacted and committed, so the leader can resume after them
+            return {"conflict_term": 0, "conflict_index": self._snapshot_index + 1}
+
+        conflict_term = self.term_at(prev_log_index)
+        conflict_index = prev_log_index
+        while (
+            conflict_index - 1 > self._snapshot_index
+            and self.term_at(conflict_index - 1) == conflict_term
+        ):
+            conflict_index -= 1
+
+        return {"conflict_term": conflict_term, "conflict_index": conflict_index}
+
+    def merge_entries(self, prev_log_index: int, entries: list[Record]) -> None:
+        """
+        Append entries after prev_log_index, only truncating the log on a
+        conflict. Requests may be reordered or duplicated, so an older one
+        must not drop entries appended by a newer one.
+        """
+        for offset, entry in enumerate(entries):
+            index = prev_log_index + offset + 1
+            if index <= self._snapshot_index:
+                # Already compacted, hence committed
+                continue
+            if index > self.last_log_index():
+                self.extend_log(entries[offset:])
+                self._storage.append(index, entries[offset:])
+                return
+            if self.term_at(index) != entry[0]:
+                self.truncate_log(index)
+                self.extend_log(entries[offset:])
+                # Records at an index replace the ones stored before
+                self._storage.append(index, entries[offset:])
+                return
+
+    # Forwarding to the leader
+
+    def handle_kvs_op(self, msg) -> Follower:
+        if self._leader_id is None or (not FORWARD_READS and is_read_only(msg.body)):
+            return super().handle_kvs_op(msg)
+
+        self._forward_batch.append({"client": msg.src, **vars(msg.body)})
+        if len(self._forward_batch) >= BATCH_MAX_ENTRIES:
+            self.forward_batch()
+        elif len(self._forward_batch) == 1:
+            self._forward_timer = loop.call_later(BATCH_MAX_DELAY, self.forward_timeout)
+
+        return self
+
+    def forward_timeout(self) -> None:
+        post(self._node_id, type="flush_forward_batch")
+
+    def handle_flush_forward_batch(self, msg) -> Follower:
+        if self._forward_batch:
+            self.forward_batch()
+        return self
+
+    def forward_batch(self) -> None:
+        """
+        Forward every waiting op to the leader in a single message
+        """
+        if self._forward_timer is not None:
+            self._forward_timer.cancel()
+            self._forward_timer = None
+        if self._leader_id is None:
+            send_all(
+                self._node_id,
+                [
+                    (
+                        op["client"],
+                        {
+                            "in_reply_to": op["msg_id"],
+                            "type": "error",
+                            "code": 11,
+                            "text": "no leader to forward the request to",
+                        },
+                    )
+                    for op in self._forward_batch
+                ],
+            )
+        else:
+            send(
+                self._node_id,
+                self._leader_id,
+                type="forward",
+                term=self._current_term,
+                ops=self._forward_batch,
+            )
+            metrics.increment("forwarded_ops", len(self._forward_batch))
+        self._forward_batch = []
+
     # Handle message sent to self
-    def handle_turn_candidate(self, msg) -> Candidate:
-        return Candidate.transition_from(self)
+    def handle_turn_candidate(self, msg) -> Follower | Candidate | Leader:
+        return self.start_pre_vote()
+
+    def handle_campaign(self, msg) -> Follower | Candidate | Leader:
+        if self._leader_id is None:
+            return self.start_pre_vote()
+        return self
+
+    # Pre-vote: the term is only bumped once a majority would grant the vote,
+    # so a node that was cut off can't depose a healthy leader when it returns
+
+    def start_pre_vote(self) -> Follower | Candidate | Leader:
+        if self.is_learner():
+            # Learners wait for a leader to show up
+            self._timer.reset()
+            return self
+
+        if self._forward_batch:
+            # The leader that was known may still take them
+            self.forward_batch()
+        self._leader_id = None
+        self._pre_votes = {self._node_id}
+        # Try again on the next timeout if no majority answers
+        self._timer.reset()
+        metrics.increment("elections.pre_votes")
+        for dest_id in self._voter_ids:
+            send(
+                self._node_id,
+                dest_id,
+                type="pre_vote",
+                term=self._current_term + 1,
+                candidate_id=self._node_id,
+                last_log_index=self.last_log_index(),
+                last_log_term=self.last_log_term(),
+            )
+        return self.check_pre_vote()
+
+    def handle_pre_vote_response(self, msg) -> Follower | Candidate | Leader:
+        if self._pre_votes is None or not msg.body.vote_granted:
+            return self
+        self._pre_votes.add(msg.src)
+        return self.check_pre_vote()
+
+    def check_pre_vote(self) -> Follower | Candidate | Leader:
+        if len(self._pre_votes) >= self.majority():
+            return Candidate.transition_from(self)
+        return self
+
+    def handle_timeout_now(self, msg) -> Follower | Candidate | Leader:
+        if msg.body.term != self._current_term:
+            return self
+        # The leader handed leadership over, no pre-vote is needed
+        return Candidate.transition_from(self, leadership_transfer=True)
 
     def handle_request_vote(self, msg):
+        if self.leader_may_hold_lease() and not msg.body.leadership_transfer:
+            return self.reject_vote(msg)
+
         self._timer.reset()
         return super().handle_request_vote(msg)
 
+    def leader_may_hold_lease(self) -> bool:
+        return monotonic() - self._leader_contact_at < LOWER_TIMEOUT
+
     def get_leader_id(self) -> NodeID | None:
         return self._leader_id
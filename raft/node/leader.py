@@ -1,10 +1,26 @@
 from __future__ import annotations
-from math import ceil
-from raft.node.node import Node, NodeID, Entry
-from raft.utils.ms import send, reply
+from collections import deque
+from raft.node.node import Node, NodeID
+from raft.log import Command, Record, is_read_only
+from raft.utils.ms import send, send_all, post, reply
+from raft.utils.codec import Message, decode_body
+from raft.utils.metrics import metrics
+from time import perf_counter, monotonic
+from typing import Any
 import logging
-from multitimer import MultiTimer
-from raft.config import HEARTBIT_RATE
+from raft.utils.event_loop import loop, TimerHandle
+from raft.utils.periodic_timer import PeriodicTimer
+from json import dumps
+from raft.config import (
+    HEARTBIT_RATE,
+    LOWER_TIMEOUT,
+    LEASE_DURATION,
+    BATCH_MAX_ENTRIES,
+    BATCH_MAX_DELAY,
+    APPEND_ENTRIES_MAX_ENTRIES,
+    APPEND_ENTRIES_MAX_BYTES,
+    APPEND_ENTRIES_WINDOW,
+)
 
 
 class Leader(Node):
@@ -12,74 +28,640 @@ class Leader(Node):
     _next_index: dict[NodeID, int]
     # Index of highest log entry known to be replicated on server
     _match_index: dict[NodeID, int]
+    # Number of client ops appended but not yet sent to the followers
+    _batch_size: int
+    _batch_timer: TimerHandle | None
+    # Number of non empty AppendEntries sent to each server without response
+    _in_flight: dict[NodeID, int]
+    # Servers that responded since the last heartbeat
+    _responded: set[NodeID]
+    # Serialized size of each log entry, filled lazily
+    _entry_sizes: list[int]
+    # Client and message id to reply to, and time at which it was appended,
+    # for each entry appended by this leader
+    _clients: dict[int, tuple[str, int, float]]
+    # ReadIndex: every AppendEntries carries the last read round started, a
+    # read is confirmed once a majority acked a round started after it arrived
+    _read_round: int
+    _acked_round: dict[NodeID, int]
+    # (round, read index, client, msg_id, request body, arrival) of
+    # unconfirmed reads
+    _pending_reads: deque[tuple[int, int, str, int, Any, float]]
+    # Confirmed reads, waiting for lastApplied to reach their read index
+    _ready_reads: deque[tuple[int, int, str, int, Any, float]]
+    # Send time of the latest AppendEntries acked by each server
+    _acked_at: dict[NodeID, float]
+    # When this node became leader
+    _elected_at: float
+    # Node leadership is being handed over to, None when there is no transfer
+    _transfer_target: NodeID | None
+    # Admin client to reply to once the target was told to start an election
+    _transfer_client: tuple[str, int] | None
+    _transfer_started_at: float
+    # Once a target was told to start an election its voters no longer wait
+    # for this leader to time out, so its lease can't be trusted anymore
+    _lease_given_up: bool
+    # When the last transfer was aborted, acks of AppendEntries sent after it
+    # by a majority show the voters still follow this leader
+    _transfer_aborted_at: float
+    # Follower that forwarded each (client, msg_id) op
+    _forwarded: dict[tuple[str, int], NodeID]
+    # Replies to clients and to relay through each follower, all written at
+    # once when the current callback is done
+    _outbox: list[tuple[str, dict]]
+    _relays: dict[NodeID, list[list]]
+    # (client, request id) of the ops appended by this leader and not applied
+    _appended_sessions: set[tuple[str, int]]
 
     def __init__(self, node_id: NodeID, node_ids: list[NodeID]):
         super().__init__(node_id, node_ids)
-        self._timer = MultiTimer(HEARTBIT_RATE, self.heartbeat, runonstart=False)
+        self._timer = PeriodicTimer(HEARTBIT_RATE, self.heartbeat)
         self._timer.start()
         self._next_index = dict.fromkeys(node_ids, 1)
         self._match_index = dict.fromkeys(node_ids, 0)
+        self._batch_size = 0
+        self._batch_timer = None
+        self._in_flight = dict.fromkeys(node_ids, 0)
+        self._responded = set()
+        self._entry_sizes = []
+        self._clients = {}
+        self._read_round = 0
+        self._acked_round = dict.fromkeys(node_ids, 0)
+        self._pending_reads = deque()
+        self._ready_reads = deque()
+        self._acked_at = dict.fromkeys(node_ids, 0.0)
+        self._elected_at = monotonic()
+        self._transfer_target = None
+        self._transfer_client = None
+        self._transfer_started_at = 0.0
+        self._lease_given_up = False
+        self._transfer_aborted_at = 0.0
+        self._forwarded = {}
+        self._outbox = []
+        self._relays = {}
+        self._appended_sessions = set()
         self._voted_for = node_id
         logging.info("Leader %s initialized", node_id)
 
     @classmethod
     def transition_from(cls, node: Node) -> Leader:
         logging.info(f"Transitioning from {node} to Leader")
+        metrics.increment("elections.won")
         new_state: Leader = super().transition_from(node)
         new_state._next_index = dict.fromkeys(
-            new_state._node_ids, len(new_state._log) + 1
+            new_state._node_ids, new_state.last_log_index() + 1
         )
+        # Entries of previous terms are only known to be committed once an
+        # entry of the current term is, until then ReadIndex, the lease and
+        # membership changes are off. Raft's no-op gets there without waiting
+        # for a client write.
+        new_state.append_noop()
         return new_state
 
+    def append_noop(self) -> None:
+        command = Command("noop", None)
+        self.append_entry(self._current_term, command)
+        self._storage.append(
+            self.last_log_index(), [command.to_record(self._current_term)]
+        )
+        self.flush_batch()
+
+    def stop_timers(self) -> None:
+        super().stop_timers()
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+
     def heartbeat(self):
-        send(self._node_id, self._node_id, type="heartbeat")
+        post(self._node_id, type="heartbeat")
+
+    def batch_timeout(self):
+        post(self._node_id, type="flush_batch")
 
     # Message handlers
 
-    def handle_heartbeat(self, msg) -> Leader:
+    def handle_heartbeat(self, msg) -> Leader | Follower:
+        if not self.has_quorum_contact():
+            # Check-quorum: a leader cut off from the majority steps down, the
+            # majority may have elected another one by now
+            logging.info("Leader %s lost contact with the majority", self._node_id)
+            metrics.increment("elections.check_quorum_step_downs")
+            from raft.node.follower import Follower
+
+            return Follower.transition_from(self)
+
+        if (
+            self._transfer_target is not None
+            and monotonic() - self._transfer_started_at > LOWER_TIMEOUT
+        ):
+            self.abort_transfer()
+
+        # Heartbeats also serve as a round for reads whose round was lost
+        self.start_read_round()
         self.append_empty_entries_to_all()
 
         return self
 
+    def of_voters(self, by_node: dict[NodeID, Any]) -> list:
+        # Learners don't count towards any majority
+        return [by_node[node] for node in self._voter_ids]
+
+    def has_quorum_contact(self) -> bool:
+        """
+        Whether a majority acked an AppendEntries sent within the last election
+        timeout
+        """
+        now = monotonic()
+        majority = self.majority()
+        if majority == 1 or now - self._elected_at < LOWER_TIMEOUT:
+            return True
+        # The leader itself is always part of the majority
+        acked_at = sorted(self.of_voters(self._acked_at), reverse=True)[majority - 2]
+        return now - acked_at < LOWER_TIMEOUT
+
+    def handle_pre_vote(self, msg) -> Leader:
+        # Still leading, check-quorum steps down a leader the majority lost
+        reply(
+            msg,
+            type="pre_vote_response",
+            term=self._current_term,
+            vote_granted=False,
+        )
+        return self
+
+    def handle_flush_batch(self, msg) -> Leader:
+        if self._batch_size > 0:
+            self.flush_batch()
+
+        return self
+
     def handle_kvs_op(self, msg) -> Leader:
-        self._log.append(Entry(self._current_term, msg))
+        if self._transfer_target is not None and not is_read_only(msg.body):
+            # The target must catch up with a log that doesn't grow
+            self.send_to_client(
+                msg.src,
+                msg.body.msg_id,
+                type="error",
+                code=11,
+                text="leadership transfer in progress",
+            )
+            return self
 
-        if len(self._node_ids) > 0:
-            self.append_entries_to_all()
+        if is_read_only(msg.body):
+            if self.can_read_index():
+                self.queue_read(msg)
+            else:
+                self.append_to_log(msg)
         else:
-            self.try_commit()
+            session = (msg.src, msg.body.msg_id)
+            if self._store.is_applied(*session):
+                # Retry of an op already applied, only the response to the
+                # client's last request is still cached
+                metrics.increment("sessions.duplicates")
+                if (response := self._store.session_response(*session)) is not None:
+                    self.send_to_client(*session, **response)
+                else:
+                    self._forwarded.pop(session, None)
+                return self
+            if session in self._appended_sessions:
+                # Retry of an op in the log, its reply answers both
+                metrics.increment("sessions.duplicates")
+                return self
+            self.append_to_log(msg, session)
+        self.add_to_batch()
 
         return self
 
+    def add_to_batch(self) -> None:
+        self._batch_size += 1
+
+        if self._batch_size >= BATCH_MAX_ENTRIES:
+            self.flush_batch()
+        elif self._batch_size == 1:
+            # First op of a new batch, wait for more ops to group with it
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+            self._batch_timer = loop.call_later(BATCH_MAX_DELAY, self.batch_timeout)
+
+    # Leadership transfer
+
+    def handle_transfer_leadership(self, msg) -> Leader:
+        target = msg.body.target
+        if target is None and self._voter_ids:
+            target = max(self._voter_ids, key=lambda node: self._match_index[node])
+
+        if target not in self._voter_ids:
+            reply(
+                msg,
+                type="error",
+                code=12,
+                text=f"can't transfer leadership to {target}",
+            )
+        elif self._transfer_target is not None:
+            reply(msg, type="error", code=11, text="leadership transfer in progress")
+        else:
+            logging.info("Transferring leadership to %s", target)
+            self._transfer_target = target
+            self._transfer_client = (msg.src, msg.body.msg_id)
+            self._transfer_started_at = monotonic()
+            # Send the pending ops along, the log stops growing from here
+            self.flush_batch()
+            self.try_transfer()
+
+        return self
+
+    def try_transfer(self) -> None:
+        """
+        Tell the target to start an election once it has the whole log
+        """
+        if (
+            self._transfer_client is None
+            or self._match_index[self._transfer_target] < self.last_log_index()
+        ):
+            return
+
+        self._lease_given_up = True
+        send(
+            self._node_id,
+            self._transfer_target,
+            type="timeout_now",
+            term=self._current_term,
+        )
+        metrics.increment("elections.transfers")
+        reply_to = self._transfer_client
+        self._transfer_client = None
+        send(
+            self._node_id,
+            reply_to[0],
+            in_reply_to=reply_to[1],
+            type="transfer_leadership_ok",
+            target=self._transfer_target,
+        )
+
+    def abort_transfer(self) -> None:
+        # The target didn't catch up or didn't win, keep leading
+        logging.info("Leadership transfer to %s timed out", self._transfer_target)
+        if self._transfer_client is not None:
+            send(
+                self._node_id,
+                self._transfer_client[0],
+                in_reply_to=self._transfer_client[1],
+                type="error",
+                code=0,
+                text="leadership transfer timed out",
+            )
+        self._transfer_target = None
+        self._transfer_client = None
+        self._transfer_aborted_at = monotonic()
+
+    # Membership changes
+
+    def handle_change_membership(self, msg) -> Leader:
+        add, remove = msg.body.add, msg.body.remove
+        voters = self._configs[-1][1]
+
+        if (add is None) == (remove is None):
+            reply(msg, type="error", code=12, text="either add or remove a member")
+        elif add in voters or (remove is not None and remove not in voters):
+            reply(
+                msg,
+                type="error",
+                code=22,
+                text=f"{add or remove} is {'already' if add else 'not'} a member",
+            )
+        elif remove == self._node_id:
+            reply(
+                msg,
+                type="error",
+                code=12,
+                text="transfer leadership before removing the leader",
+            )
+        elif self._configs[-1][0] > self._commit_index or not self.can_read_index():
+            # A new leader commits an entry of its own term first, so that a
+            # change of the previous leader can't overlap with this one
+            reply(msg, type="error", code=11, text="membership change in progress")
+        elif self._transfer_target is not None:
+            reply(msg, type="error", code=11, text="leadership transfer in progress")
+        else:
+            if add is not None:
+                new_voters = sorted([*voters, add])
+            else:
+                new_voters = [node for node in voters if node != remove]
+            logging.info("Changing voters to %s", new_voters)
+            command = Command("config", None, value=new_voters)
+            self.append_command(command, msg.src, msg.body.msg_id)
+            self.flush_batch()
+
+        return self
+
+    def add_peer(self, node: NodeID) -> None:
+        # A new member starts empty, nextIndex backs off from the end of the log
+        self._next_index[node] = self.last_log_index() + 1
+        self._match_index[node] = 0
+        self._in_flight[node] = 0
+        self._acked_round[node] = 0
+        self._acked_at[node] = 0.0
+
+    def handle_read_index(self, msg) -> Leader:
+        # A learner asking for the index its reads have to wait for
+        if self.can_read_index():
+            self.queue_read(msg)
+            self.add_to_batch()
+        else:
+            super().handle_read_index(msg)
+        return self
+
+    def handle_forward(self, msg) -> Leader:
+        for op in msg.body.ops:
+            client_id = op.pop("client")
+            self._forwarded[(client_id, op["msg_id"])] = msg.src
+            self.handle_kvs_op(Message(None, client_id, self._node_id, decode_body(op)))
+
+        return self
+
+    def send_to_client(self, client_id: str, msg_id: int, **body) -> None:
+        """
+        Reply to a client directly, or through the follower it sent the op to
+        """
+        if not self._outbox and not self._relays:
+            loop.call_soon(self.flush_replies)
+
+        via = self._forwarded.pop((client_id, msg_id), None)
+        if via is None:
+            self._outbox.append((client_id, {"in_reply_to": msg_id, **body}))
+        else:
+            self._relays.setdefault(via, []).append([client_id, msg_id, body])
+
+    def flush_replies(self) -> None:
+        for node, replies in self._relays.items():
+            self._outbox.append(
+                (
+                    node,
+                    {
+                        "type": "forward_reply",
+                        "term": self._current_term,
+                        "replies": replies,
+                    },
+                )
+            )
+        send_all(self._node_id, self._outbox)
+        self._outbox = []
+        self._relays = {}
+
+    def append_to_log(self, msg, session: tuple[str, int] | None = None) -> None:
+        command = Command.from_request(msg.body, session)
+        if session is not None:
+            self._appended_sessions.add(session)
+        self.append_command(command, msg.src, msg.body.msg_id)
+
+    def append_command(self, command: Command, client_id: str, msg_id: int) -> None:
+        self.append_entry(self._current_term, command)
+        index = self.last_log_index()
+        self._clients[index] = (client_id, msg_id, perf_counter())
+        self._storage.append(index, [command.to_record(self._current_term)])
+
+    def flush_batch(self) -> None:
+        """
+        Replicate every pending op in a single AppendEntries round.
+        """
+        self._batch_size = 0
+        # Group commit, one fsync for the whole batch
+        self._storage.sync()
+        reads_waiting = self.start_read_round()
+        self.append_entries_to_all()
+        if self._voter_ids:
+            if reads_waiting:
+                self.confirm_leadership()
+        else:
+            self.try_commit()
+            self.confirm_reads()
+
+    # ReadIndex
+
+    def can_read_index(self) -> bool:
+        # The commit index is only known to be up to date once an entry of the
+        # current term is committed, until then reads go through the log
+        return self.term_at(self._commit_index) == self._current_term
+
+    def queue_read(self, msg) -> None:
+        self._pending_reads.append(
+            (
+                self._read_round + 1,
+                self._commit_index,
+                msg.src,
+                msg.body.msg_id,
+                msg.body,
+                perf_counter(),
+            )
+        )
+
+    def start_read_round(self) -> bool:
+        """
+        Start a new round if reads wait for one, a single round confirms every
+        read queued since the previous one
+        """
+        if self._pending_reads and self._pending_reads[-1][0] > self._read_round:
+            self._read_round += 1
+            return True
+        return False
+
+    def confirm_leadership(self) -> None:
+        """
+        Empty AppendEntries to every node, each response of the current term
+        shows that the node still follows this leader
+        """
+        for node in self._node_ids:
+            self.append_entries(
+                node,
+                empty_entries=True,
+                prev_log_idx=max(self._match_index[node], self._snapshot_index),
+            )
+
+    def confirm_reads(self) -> None:
+        majority = self.majority()
+        # The leader is part of every round
+        if majority > 1:
+            acked = sorted(self.of_voters(self._acked_round), reverse=True)
+            confirmed_round = acked[majority - 2]
+        else:
+            confirmed_round = self._read_round
+
+        while self._pending_reads and self._pending_reads[0][0] <= confirmed_round:
+            self._ready_reads.append(self._pending_reads.popleft())
+
+        self.serve_reads()
+
+    def serve_reads(self) -> None:
+        while self._ready_reads and self._ready_reads[0][1] <= self._last_applied:
+            _, index, client_id, msg_id, body, arrived_at = self._ready_reads.popleft()
+            if body.type == "read_index":
+                self.send_to_client(
+                    client_id,
+                    msg_id,
+                    type="read_index_response",
+                    term=self._current_term,
+                    read_id=body.read_id,
+                    index=index,
+                )
+            elif body.type == "txn":
+                self.send_to_client(
+                    client_id, msg_id, type="txn_ok", txn=self._store.transact(body.txn)
+                )
+            elif value := self._store.read(body.key):
+                self.send_to_client(client_id, msg_id, type="read_ok", value=value)
+            else:
+                self.send_to_client(
+                    client_id, msg_id, type="error", code=20, text="key not found"
+                )
+            metrics.observe("read_index_latency", perf_counter() - arrived_at)
+
+    def apply(self) -> None:
+        super().apply()
+        self.serve_reads()
+
+    # Leader lease
+
+    def has_lease(self) -> bool:
+        """
+        Whether no other leader can have been elected, so that the store can
+        be read without contacting any other node
+        """
+        if not self.can_read_index():
+            return False
+        if self._last_applied < self._commit_index:
+            # Committed entries are applied in batches, a follower may already
+            # have served a quorum read of an entry the store doesn't show yet
+            return False
+
+        majority = self.majority()
+        if majority == 1:
+            return True
+
+        # The leader itself is always part of the majority
+        acked_at = sorted(self.of_voters(self._acked_at), reverse=True)[majority - 2]
+        if self._lease_given_up:
+            if (
+                self._transfer_target is not None
+                or acked_at <= self._transfer_aborted_at
+            ):
+                return False
+            # The transfer was aborted and a majority acked this term since
+            self._lease_given_up = False
+        return monotonic() < acked_at + LEASE_DURATION
+
+    def get_leader_id(self) -> NodeID | None:
+        return self._node_id
+
     def handle_append_entries_response(self, msg) -> Leader:
+        if msg.body.term != self._current_term:
+            # Answer to a request of an earlier term this node led, the
+            # follower's log may have changed since
+            return self
+
+        self._responded.add(msg.src)
+        if msg.body.entry_count:
+            # Empty requests, heartbeats and read rounds, take no window slot
+            self._in_flight[msg.src] = max(0, self._in_flight[msg.src] - 1)
+
+        self._acked_at[msg.src] = max(self._acked_at[msg.src], msg.body.sent_at)
+        self._acked_round[msg.src] = max(
+            self._acked_round[msg.src], msg.body.read_round
+        )
+        if self._pending_reads:
+            self.confirm_reads()
+
         if msg.body.success:
             # If successful:
             #   update nextIndex and matchIndex for follower
-            self._match_index[msg.src] = msg.body.last_index
-            self._next_index[msg.src] = msg.body.last_index + 1
+            # Responses may arrive out of order, so never move them backwards
+            self._match_index[msg.src] = max(
+                self._match_index[msg.src], msg.body.last_index
+            )
+            self._next_index[msg.src] = max(
+                self._next_index[msg.src], msg.body.last_index + 1
+            )
+            metrics.gauge(
+                f"replication_lag.{msg.src}",
+                self.last_log_index() - self._match_index[msg.src],
+            )
+            if msg.src == self._transfer_target:
+                self.try_transfer()
             self.try_commit()
+            self.replicate(msg.src)
 
-        else:
+        elif self.match_index_is_behind(msg.src, msg.body.prev_log_index):
             # If AppendEntries fails because of log inconsistency:
             #   decrement nextIndex and retry
-            self._next_index[msg.src] = max(1, self._next_index[msg.src] - 1)
-            self.append_entries(msg.src)
+            # The follower's conflict hint lets nextIndex skip a whole term.
+            # Every request still in flight was sent after the rejected one,
+            # so they will be rejected as well
+            self._next_index[msg.src] = max(
+                self._match_index[msg.src] + 1,
+                min(
+                    self.next_index_from_conflict(
+                        msg.body.conflict_term, msg.body.conflict_index
+                    ),
+                    msg.body.prev_log_index,
+                ),
+            )
+            self._in_flight[msg.src] = 0
+            self.replicate(msg.src)
+
+        return self
+
+    def handle_install_snapshot_response(self, msg) -> Leader:
+        self._responded.add(msg.src)
+        self._in_flight[msg.src] = max(0, self._in_flight[msg.src] - 1)
+
+        self._match_index[msg.src] = max(self._match_index[msg.src], msg.body.last_index)
+        self._next_index[msg.src] = max(
+            self._next_index[msg.src], msg.body.last_index + 1
+        )
+        self.try_commit()
+        self.replicate(msg.src)
 
         return self
 
+    def next_index_from_conflict(self, conflict_term: int, conflict_index: int) -> int:
+        """
+        If the leader has entries of the conflicting term, resume after its last
+        one, otherwise skip the follower's whole conflicting term.
+        """
+        if conflict_term > 0:
+            for index in range(self.last_log_index(), self._snapshot_index, -1):
+                term = self.term_at(index)
+                if term == conflict_term:
+                    return index + 1
+                if term < conflict_term:
+                    break
+
+        return conflict_index
+
+    def match_index_is_behind(self, node: NodeID, rejected_index: int) -> bool:
+        """
+        Check if a rejection is still relevant, stale rejections of requests
+        sent before the last backtrack are ignored.
+        """
+        return self._match_index[node] < rejected_index < self._next_index[node]
+
     # AppendEntries RPC
 
-    def append_entries(self, node: NodeID, empty_entries=False) -> None:
+    def append_entries(
+        self, node: NodeID, empty_entries=False, prev_log_idx: int | None = None
+    ) -> None:
         """
         Append entries to a node.
         """
-        prev_log_idx = self._next_index[node] - 1
+        if prev_log_idx is None:
+            prev_log_idx = self._next_index[node] - 1
+
+        if prev_log_idx < self._snapshot_index:
+            # The entries it needs were compacted
+            self.send_snapshot(node)
+            return
 
-        prev_log_term = 0
-        if prev_log_idx > 0:
-            prev_log_term = self._log[prev_log_idx - 1].term
+        prev_log_term = self.term_at(prev_log_idx)
 
-        entries = self._log[prev_log_idx:] if not empty_entries else []
+        entries = self.bounded_entries(prev_log_idx) if not empty_entries else []
 
         send(
             self._node_id,
@@ -91,58 +673,137 @@ class Leader(Node):
             prev_log_term=prev_log_term,
             entries=entries,
             leader_commit=self._commit_index,
+            read_round=self._read_round,
+            sent_at=monotonic(),
+        )
+
+        if entries:
+            # Optimistically assume the entries will be accepted, a rejection
+            # moves nextIndex back
+            self._next_index[node] = prev_log_idx + len(entries) + 1
+            self._in_flight[node] += 1
+
+    def send_snapshot(self, node: NodeID) -> None:
+        """
+        InstallSnapshot RPC, the store state at lastApplied is sent whole.
+        """
+        send(
+            self._node_id,
+            node,
+            type="install_snapshot",
+            term=self._current_term,
+            leader_id=self._node_id,
+            last_included_index=self._last_applied,
+            last_included_term=self.term_at(self._last_applied),
+            data=self.snapshot_data(),
         )
 
+        self._next_index[node] = self._last_applied + 1
+        self._in_flight[node] += 1
+
+    def bounded_entries(self, prev_log_idx: int) -> list[Record]:
+        """
+        Entries after prev_log_idx that fit in a single AppendEntries, at least
+        one entry is always sent.
+        """
+        last = min(self.last_log_index(), prev_log_idx + APPEND_ENTRIES_MAX_ENTRIES)
+        size = 0
+        for index in range(prev_log_idx + 1, last + 1):
+            size += self.entry_size(index)
+            if size > APPEND_ENTRIES_MAX_BYTES and index > prev_log_idx + 1:
+                last = index - 1
+                break
+
+        return self.records_between(prev_log_idx, last)
+
+    def entry_size(self, index: int) -> int:
+        # The leader only truncates its log on compaction, so sizes can be cached
+        position = index - self._snapshot_index - 1
+        while len(self._entry_sizes) <= position:
+            record = self._log.command(len(self._entry_sizes)).to_record(0)
+            self._entry_sizes.append(len(dumps(record)))
+        return self._entry_sizes[position]
+
+    def compact_log(self, count: int) -> None:
+        super().compact_log(count)
+        del self._entry_sizes[:count]
+
+    def replicate(self, node: NodeID) -> None:
+        """
+        Send the missing entries to a node, as long as its window has room.
+        """
+        while (
+            self._next_index[node] <= self.last_log_index()
+            and self._in_flight[node] < APPEND_ENTRIES_WINDOW
+        ):
+            self.append_entries(node)
+
     def append_entries_to_all(self) -> None:
         """
         Append entries to all nodes that aren't updated.
         """
+        # Pending ops are sent along, so they no longer belong to a batch
+        self._batch_size = 0
         for node in self._node_ids:
-            if self._next_index[node] <= len(self._log):
-                self.append_entries(node)
+            self.replicate(node)
 
     def append_empty_entries_to_all(self) -> None:
         """
         Append empty entry to all nodes, used as heartbeat.
         """
         for node in self._node_ids:
-            self.append_entries(node, empty_entries=True)
+            if self._in_flight[node] > 0 and node not in self._responded:
+                # No response during a whole heartbeat, the requests in flight
+                # are assumed lost and replication restarts from matchIndex
+                self._in_flight[node] = 0
+                self._next_index[node] = self._match_index[node] + 1
 
-    # KeyValueStore ops
+            if self._in_flight[node] > 0:
+                # Entries are still flowing, only keep the leadership alive
+                if self._match_index[node] >= self._snapshot_index:
+                    self.append_entries(
+                        node, empty_entries=True, prev_log_idx=self._match_index[node]
+                    )
+            elif self._next_index[node] <= self.last_log_index():
+                self.replicate(node)
+            else:
+                self.append_entries(node, empty_entries=True)
 
-    def apply_read(self, msg) -> None:
-        value = self._store.read(msg.body.key)
-        if value:
-            reply(msg, type="read_ok", value=value)
-        else:
-            reply(msg, type="error", code=20, text="key not found")
+        self._responded.clear()
 
-    def apply_write(self, msg) -> None:
-        self._store.write(msg.body.key, msg.body.value)
-        reply(msg, type="write_ok")
+    # KeyValueStore ops
 
-    def apply_cas(self, msg) -> None:
-        value = self._store.read(msg.body.key)
+    def reply_to_client(self, index: int, **body) -> None:
+        """
+        Reply to the client of the entry at index, if it was sent to this leader
+        """
+        if (client := self._clients.pop(index, None)) is not None:
+            client_id, msg_id, appended_at = client
+            self._appended_sessions.discard((client_id, msg_id))
+            self.send_to_client(client_id, msg_id, **body)
+            metrics.observe("commit_latency", perf_counter() - appended_at)
 
-        if value is None:
-            reply(msg, type="error", code=20, text="key not found")
-        elif value != msg.body.__dict__["from"]:
-            reply(msg, type="error", code=22, text='"from" is different')
-        else:
-            self._store.write(msg.body.key, msg.body.to)
-            reply(msg, type="cas_ok")
+    def forget_client(self, index: int) -> None:
+        # Late duplicate of an older request, the first attempt was answered
+        if (client := self._clients.pop(index, None)) is not None:
+            self._appended_sessions.discard(client[:2])
+            self._forwarded.pop(client[:2], None)
 
     def try_commit(self) -> None:
         # If there exists an N such that N > commitIndex,
         # a majority of matchIndex[i] >= N,
         # and log[N].term == currentTerm:
         #   set commitIndex = N
-        log_indexes = [i for i in self._match_index.values() if i > self._commit_index]
-        majority = ceil((len(self._node_ids) + 1) / 2)
+        # The leader's own log counts towards the majority, so it must be durable
+        self._storage.sync()
+        log_indexes = [
+            i for i in self.of_voters(self._match_index) if i > self._commit_index
+        ]
+        majority = self.majority()
 
         if len(log_indexes) + 1 >= majority:
-            next_commit_index = min(log_indexes, default=len(self._log))
-            if self._log[next_commit_index - 1].term == self._current_term:
+            next_commit_index = min(log_indexes, default=self.last_log_index())
+            if self.term_at(next_commit_index) == self._current_term:
                 self._commit_index = next_commit_index
-                self.apply()
+                self.schedule_apply()
                 self.append_entries_to_all()
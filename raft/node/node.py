@@ -1,60 +1,127 @@
 from __future__ import annotations
 from abc import ABC
 from typing import Any
-from raft.utils.ms import reply
+from raft.utils.ms import reply, send_all, post
 from raft.utils.random_timer import RandomTimer
-from multitimer import MultiTimer
+from raft.utils.periodic_timer import PeriodicTimer
 import logging
 from raft.key_value_store import KeyValueStore
+from raft.log_storage import LogStorage
+from raft.log import Command, RaftLog, Record
+from raft.config import (
+    SNAPSHOT_THRESHOLD,
+    APPLY_BATCH_ENTRIES,
+    LEARNERS,
+    SHARD_SEPARATOR,
+)
+from raft.utils.metrics import metrics
 
 NodeID = str
 
 
-class Entry:
-    term: int
-    command: Any  # for now
-
-    def __init__(self, term: int, command: Any) -> None:
-        self.term = term
-        self.command = command
+def is_static_learner(node_id: NodeID) -> bool:
+    # Learner in the LEARNERS setting, the initial configuration. The groups
+    # of a learner node are all learners.
+    return node_id.split(SHARD_SEPARATOR)[0] in LEARNERS
 
 
 class Node(ABC):
     _node_id: NodeID
+    # Every other node, the log is replicated to all of them
     _node_ids: list[NodeID]
+    # The other nodes that vote and count towards majorities
+    _voter_ids: list[NodeID]
+    # Index of each configuration entry still in the log, or of the snapshot,
+    # and its voters, this node included. The latest one is in use, committed
+    # or not.
+    _configs: list[tuple[int, list[NodeID]]]
     _store: KeyValueStore
-    _timer: RandomTimer | MultiTimer
+    _timer: RandomTimer | PeriodicTimer
+    _storage: LogStorage
 
     # Raft vars
     _current_term: int
     _voted_for: NodeID | None
-    _log: list[Entry]
+    _log: RaftLog
     _commit_index: int = 0
     _last_applied: int = 0
+    # Last entry covered by the store snapshot, the log only keeps the
+    # entries that follow it
+    _snapshot_index: int = 0
+    _snapshot_term: int = 0
+    # Write and cas entries that are still to be applied, by key
+    _pending_writes: dict[Any, int]
+    # An apply_committed message is on its way
+    _apply_scheduled: bool = False
 
     def __init__(self, node_id: NodeID, node_ids: list[NodeID]) -> None:
         self._node_id = node_id
         self._node_ids = node_ids
+        self._voter_ids = [node for node in node_ids if not is_static_learner(node)]
+        voters = [*self._voter_ids]
+        if not is_static_learner(node_id):
+            voters.append(node_id)
+        self._configs = [(0, sorted(voters))]
         self._store = KeyValueStore()
+        self._storage = LogStorage()
 
         self._current_term = 0
         self._voted_for = None
-        self._log = []
+        self._log = RaftLog()
         self._commit_index = 0
         self._last_applied = 0
+        self._snapshot_index = 0
+        self._snapshot_term = 0
+        self._pending_writes = {}
 
     @classmethod
     def transition_from(cls, node: Node):
-        node._timer.stop()
+        node.stop_timers()
         new_state = cls(node._node_id, node._node_ids)
         new_state._store = node._store
+        new_state._storage = node._storage
         new_state._current_term = node._current_term
         new_state._voted_for = node._voted_for
         new_state._log = node._log
         new_state._commit_index = node._commit_index
         new_state._last_applied = node._last_applied
+        new_state._snapshot_index = node._snapshot_index
+        new_state._pending_writes = node._pending_writes
+        new_state._snapshot_term = node._snapshot_term
+        new_state._voter_ids = node._voter_ids
+        new_state._configs = node._configs
         return new_state
 
+    def recover(self, storage: LogStorage) -> None:
+        """
+        Rebuild the persistent state from storage, and keep persisting to it
+        """
+        state, snapshot, entries = storage.load()
+        self._storage = storage
+        self._current_term = state["term"]
+        self._voted_for = state["voted_for"]
+
+        if snapshot is not None:
+            self._store.restore(snapshot["data"])
+            self._snapshot_index = snapshot["index"]
+            self._snapshot_term = snapshot["term"]
+            self._commit_index = self._last_applied = self._snapshot_index
+            self.reset_configs(snapshot["data"]["voters"])
+
+        self.extend_log(entries)
+        logging.info(
+            "recovered term %d, snapshot %d and %d entries",
+            self._current_term,
+            self._snapshot_index,
+            len(self._log),
+        )
+
+    def persist_state(self) -> None:
+        self._storage.save_state(self._current_term, self._voted_for)
+
+    def stop_timers(self) -> None:
+        self._timer.stop()
+
     def is_from_client(self, msg) -> bool:
         return msg.src not in [self._node_id] + self._node_ids
 
@@ -66,14 +133,25 @@ class Node(ABC):
         #   set currentTerm = T, convert to follower
         if not self.is_from_client(msg) and not self.is_from_self(msg):
             # Every message that is not from a client nor from the node itself
-            # is a RAFT RPC call, that has a term
-            if msg.body.term > self._current_term:
+            # is a RAFT RPC call, that has a term. The term of a pre-vote is
+            # only the one its candidate would start.
+            if msg.body.term > self._current_term and msg.body.type != "pre_vote":
+                if (
+                    msg.body.type == "request_vote"
+                    and not msg.body.leadership_transfer
+                    and self.leader_may_hold_lease()
+                ):
+                    # Keep the term, the candidate must not depose a leader
+                    # that may still hold a lease
+                    return self.reject_vote(msg)
+
                 self._current_term = msg.body.term
                 self._voted_for = None
+                self.persist_state()
                 return Follower.transition_from(self).handle(msg)
 
         match msg.body.type:
-            case "read" | "write" | "cas":
+            case "read" | "write" | "cas" | "txn":
                 return self.handle_kvs_op(msg)
 
             case _:
@@ -81,6 +159,10 @@ class Node(ABC):
                     self, f"handle_{msg.body.type}", self.handle_unknown_message
                 )(msg)
 
+    def handle_stats(self, msg):
+        reply(msg, type="stats_ok", metrics=metrics.snapshot())
+        return self
+
     def handle_unknown_message(self, msg):
         logging.warning(f"unknown message type {msg.body.type}")
         return self
@@ -96,6 +178,7 @@ class Node(ABC):
         ):
             grant_vote = True
             self._voted_for = msg.body.candidate_id
+            self.persist_state()
 
         reply(
             msg,
@@ -105,6 +188,45 @@ class Node(ABC):
         )
         return self
 
+    def handle_pre_vote(self, msg) -> Node:
+        # Grant if the vote would be granted, without changing any state
+        grant_vote = (
+            msg.body.term > self._current_term
+            and not self.leader_may_hold_lease()
+            and self.log_is_up_to_date(msg.body.last_log_index, msg.body.last_log_term)
+        )
+        reply(
+            msg,
+            type="pre_vote_response",
+            term=self._current_term,
+            vote_granted=grant_vote,
+        )
+        return self
+
+    def handle_pre_vote_response(self, msg) -> Node:
+        # The pre-vote is over
+        return self
+
+    def majority(self) -> int:
+        # Only voters become candidates or leaders, so they count themselves
+        return (len(self._voter_ids) + 1) // 2 + 1
+
+    def is_learner(self) -> bool:
+        # Learners and removed members follow the log without voting
+        return self._node_id not in self._configs[-1][1]
+
+    def reject_vote(self, msg) -> Node:
+        reply(
+            msg,
+            type="request_vote_response",
+            term=self._current_term,
+            vote_granted=False,
+        )
+        return self
+
+    def leader_may_hold_lease(self) -> bool:
+        return False
+
     def handle_kvs_op(self, msg) -> Node:
         reply(
             msg,
@@ -114,62 +236,372 @@ class Node(ABC):
         )
         return self
 
+    def handle_forward(self, msg) -> Node:
+        # Ops forwarded to a node that is no longer the leader
+        replies = [
+            [
+                op["client"],
+                op["msg_id"],
+                {
+                    "type": "error",
+                    "code": 11,
+                    "text": f"only the leader can handle {op['type']} requests",
+                },
+            ]
+            for op in msg.body.ops
+        ]
+        reply(msg, type="forward_reply", term=self._current_term, replies=replies)
+        return self
+
+    def handle_forward_reply(self, msg) -> Node:
+        send_all(
+            self._node_id,
+            [
+                (client_id, {"in_reply_to": msg_id, **body})
+                for client_id, msg_id, body in msg.body.replies
+            ],
+        )
+        return self
+
+    def handle_read_index(self, msg) -> Node:
+        # Only the leader knows an index reads are fresh at
+        reply(
+            msg,
+            type="read_index_response",
+            term=self._current_term,
+            read_id=msg.body.read_id,
+            index=None,
+        )
+        return self
+
+    def handle_change_membership(self, msg) -> Node:
+        reply(
+            msg, type="error", code=11, text="only the leader can change membership"
+        )
+        return self
+
+    def handle_transfer_leadership(self, msg) -> Node:
+        reply(
+            msg, type="error", code=11, text="only the leader can transfer leadership"
+        )
+        return self
+
+    def handle_timeout_now(self, msg) -> Node:
+        # Only a follower of the leader that sent it starts an election
+        return self
+
+    def handle_campaign(self, msg) -> Node:
+        # Only a follower that knows no leader starts an election
+        return self
+
+    def schedule_apply(self) -> None:
+        """
+        Apply the committed entries once the current message is handled, the
+        replication path only advances the commit index
+        """
+        if not self._apply_scheduled and self._last_applied < self._commit_index:
+            self._apply_scheduled = True
+            # Through the handler, the node may have changed state by then
+            post(self._node_id, type="apply_committed")
+
+    def handle_apply_committed(self, msg) -> Node:
+        self._apply_scheduled = False
+        self.apply()
+        # Leave room for the messages that arrived meanwhile
+        self.schedule_apply()
+        return self
+
     def apply(self) -> None:
         """
-        Apply commited messages that still weren't applied
+        Apply the next batch of commited messages that still weren't applied
         """
-        for entry in self._log[self._last_applied + 1 - 1 : self._commit_index + 1 - 1]:
+        last = min(self._commit_index, self._last_applied + APPLY_BATCH_ENTRIES)
+        for command in self.commands_between(self._last_applied, last):
             self._last_applied += 1
-            match entry.command.body.type:
+            self.count_pending_writes(command, -1)
+
+            if command.session is not None and self._store.is_applied(
+                *command.session
+            ):
+                # Retry appended before the first attempt was applied, only
+                # the response to the client's last request is still cached
+                if response := self._store.session_response(*command.session):
+                    self.reply_to_client(self._last_applied, **response)
+                else:
+                    self.forget_client(self._last_applied)
+                continue
+
+            match command.type:
+                case "noop":
+                    # Appended by a new leader, nothing to apply nor reply to
+                    continue
+
                 case "read":
-                    self.apply_read(entry.command)
+                    response = self.apply_read(self._last_applied, command)
 
                 case "write":
-                    self.apply_write(entry.command)
+                    response = self.apply_write(self._last_applied, command)
 
                 case "cas":
-                    self.apply_cas(entry.command)
+                    response = self.apply_cas(self._last_applied, command)
+
+                case "txn":
+                    response = self.apply_txn(self._last_applied, command)
+
+                case "config":
+                    response = self.apply_config(self._last_applied, command)
+
+            if command.session is not None:
+                self._store.save_session(*command.session, response)
+            self.reply_to_client(self._last_applied, **response)
 
-    def apply_read(self, msg) -> None:
+        if self._last_applied - self._snapshot_index >= SNAPSHOT_THRESHOLD:
+            self.take_snapshot()
+
+    def take_snapshot(self) -> None:
+        """
+        Discard the applied entries, the store itself is the snapshot
+        """
+        self._snapshot_term = self.term_at(self._last_applied)
+        self.compact_log(self._last_applied - self._snapshot_index)
+        self._snapshot_index = self._last_applied
+        # Configurations the snapshot covers are only needed for the last one
+        while len(self._configs) > 1 and self._configs[1][0] <= self._snapshot_index:
+            self._configs.pop(0)
+        self._storage.save_snapshot(
+            self._snapshot_index, self._snapshot_term, self.snapshot_data()
+        )
+
+    def snapshot_data(self) -> dict:
+        """
+        Store state at lastApplied, with the configuration in use at that point
+        """
+        return {**self._store.snapshot(), "voters": self.config_at(self._last_applied)}
+
+    # Log mutations, keeping the pending writes up to date
+
+    def append_entry(self, term: int, command: Command) -> None:
+        self._log.append(term, command)
+        self.count_pending_writes(command, 1)
+        if command.type == "config":
+            self.add_config(self.last_log_index(), command.value)
+
+    def extend_log(self, records: list[Record]) -> None:
+        start = len(self._log)
+        self._log.extend(records)
+        first_index = self._snapshot_index + start + 1
+        for index, command in enumerate(self._log.commands(start), first_index):
+            self.count_pending_writes(command, 1)
+            if command.type == "config":
+                self.add_config(index, command.value)
+
+    def truncate_log(self, index: int) -> None:
+        """
+        Drop the entries from index onwards, none of them was applied
+        """
+        position = index - self._snapshot_index - 1
+        for command in self._log.commands(position):
+            self.count_pending_writes(command, -1)
+        self._log.truncate(position)
+
+        if self._configs[-1][0] >= index:
+            # Back to the configuration of the entries that are left
+            while self._configs[-1][0] >= index:
+                self._configs.pop()
+            self.use_config(self._configs[-1][1])
+
+    def count_pending_writes(self, command: Command, delta: int) -> None:
+        for key in command.written_keys():
+            count = self._pending_writes.get(key, 0) + delta
+            if count:
+                self._pending_writes[key] = count
+            else:
+                del self._pending_writes[key]
+
+    def has_pending_write(self, key) -> bool:
+        """
+        Whether an entry that is still to be applied writes key
+        """
+        return key in self._pending_writes
+
+    def compact_log(self, count: int) -> None:
+        self._log.drop(count)
+
+    # Membership: a server uses the latest configuration in its log, as soon
+    # as it is appended. Only one server is added or removed at a time, so the
+    # majorities of two successive configurations always overlap.
+
+    def add_config(self, index: int, voters: list[NodeID]) -> None:
+        self._configs.append((index, voters))
+        self.use_config(voters)
+
+    def reset_configs(self, voters: list[NodeID]) -> None:
+        """
+        Rebuild the configurations from a snapshot and the entries after it
+        """
+        self._configs = [(self._snapshot_index, voters)]
+        first_index = self._snapshot_index + 1
+        for index, command in enumerate(self._log.commands(0), first_index):
+            if command.type == "config":
+                self._configs.append((index, command.value))
+        self.use_config(self._configs[-1][1])
+
+    def use_config(self, voters: list[NodeID]) -> None:
+        for node in voters:
+            if node != self._node_id and node not in self._node_ids:
+                # Shared with the other states and the gateway
+                self._node_ids.append(node)
+                self.add_peer(node)
+        self._voter_ids = [node for node in voters if node != self._node_id]
+        logging.info("voters are now %s", voters)
+
+    def add_peer(self, node: NodeID) -> None:
         pass
 
-    def apply_write(self, msg) -> None:
-        self._store.write(msg.body.key, msg.body.value)
+    def config_at(self, index: int) -> list[NodeID]:
+        for config_index, voters in reversed(self._configs):
+            if config_index <= index:
+                return voters
+        return self._configs[0][1]
+
+    def install_snapshot(self, last_index: int, last_term: int, data: dict) -> None:
+        """
+        Replace the store by a snapshot received from the leader
+        """
+        if (
+            self.log_contains(last_index, last_term)
+            and last_index <= self.last_log_index()
+        ):
+            # Keep the entries that follow the snapshot
+            self.compact_log(last_index - self._snapshot_index)
+        else:
+            self._log.truncate(0)
+            self._storage.truncate(last_index + 1)
+
+        self._store.restore(data)
+        self._snapshot_index = last_index
+        self._snapshot_term = last_term
+        self._commit_index = max(self._commit_index, last_index)
+        self._last_applied = last_index
+        self._storage.save_snapshot(last_index, last_term, data)
+
+        self._pending_writes = {}
+        for command in self.commands_after(last_index):
+            self.count_pending_writes(command, 1)
+        self.reset_configs(data["voters"])
 
-    def apply_cas(self, msg) -> None:
-        value = self._store.read(msg.body.key)
+    # KeyValueStore ops, each returns the response to the client
+
+    def reply_to_client(self, index: int, **body) -> None:
+        pass
+
+    def forget_client(self, index: int) -> None:
+        pass
+
+    def apply_read(self, index: int, command: Command) -> dict:
+        value = self._store.read(command.key)
+        if value:
+            return {"type": "read_ok", "value": value}
+        return {"type": "error", "code": 20, "text": "key not found"}
+
+    def apply_write(self, index: int, command: Command) -> dict:
+        self._store.write(command.key, command.value)
+        return {"type": "write_ok"}
+
+    def apply_cas(self, index: int, command: Command) -> dict:
+        value = self._store.read(command.key)
 
         if value is None:
-            return
-        elif value != msg.body.__dict__["from"]:
-            return
+            return {"type": "error", "code": 20, "text": "key not found"}
+        elif value != command.from_:
+            return {"type": "error", "code": 22, "text": '"from" is different'}
         else:
-            self._store.write(msg.body.key, msg.body.to)
+            self._store.write(command.key, command.to)
+            return {"type": "cas_ok"}
+
+    def apply_txn(self, index: int, command: Command) -> dict:
+        if (result := self._store.transact(command.value)) is not None:
+            return {"type": "txn_ok", "txn": result}
+        return {"type": "error", "code": 30, "text": "cas of the txn doesn't match"}
+
+    def apply_config(self, index: int, command: Command) -> dict:
+        # In use since it was appended, committing it ends the change
+        return {"type": "change_membership_ok", "voters": command.value}
 
     def log_contains(self, index: int, term: int) -> bool:
-        return index == 0 or (
-            len(self._log) >= index and self._log[index - 1].term == term
+        # Entries covered by the snapshot are committed, so they match
+        return index <= self._snapshot_index or (
+            self.last_log_index() >= index and self.term_at(index) == term
         )
 
     # Check if received log is at least as up-to-date to the current log
     def log_is_up_to_date(self, last_log_index: int, last_log_term: int) -> bool:
-        my_term = self._log[-1].term if len(self._log) > 0 else 0
+        my_term = self.last_log_term()
         if my_term != last_log_term:
             return last_log_term > my_term
-        return last_log_index >= len(self._log)
+        return last_log_index >= self.last_log_index()
+
+    # Log indexes start at 1 and are absolute, the entry at index i is kept at
+    # position i - self._snapshot_index - 1 of self._log
+
+    def last_log_index(self) -> int:
+        return self._snapshot_index + len(self._log)
+
+    def last_log_term(self) -> int:
+        return self.term_at(self.last_log_index())
+
+    def term_at(self, index: int) -> int:
+        """
+        Term of the entry at index, which must not be before the snapshot
+        """
+        if index == self._snapshot_index:
+            return self._snapshot_term
+        return self._log.term(index - self._snapshot_index - 1)
+
+    def records_between(self, first: int, last: int) -> list[Record]:
+        """
+        Entries with first < index <= last, in their replicated form
+        """
+        return self._log.records(
+            first - self._snapshot_index, last - self._snapshot_index
+        )
+
+    def commands_between(self, first: int, last: int) -> list[Command]:
+        """
+        Commands of the entries with first < index <= last
+        """
+        return self._log.commands(
+            first - self._snapshot_index, last - self._snapshot_index
+        )
+
+    def commands_after(self, index: int) -> list[Command]:
+        return self._log.commands(index - self._snapshot_index)
 
     def direct_read(self, key) -> Any:
         return self._store.read(key)
 
+    def direct_txn(self, ops: list[list]) -> list[list] | None:
+        return self._store.transact(ops)
+
     def get_last_applied(self) -> int:
         return self._last_applied
 
-    def get_log(self) -> list[Entry]:
+    def get_current_term(self) -> int:
+        return self._current_term
+
+    def get_voter_ids(self) -> list[NodeID]:
+        # A new list on every membership change
+        return self._voter_ids
+
+    def get_log(self) -> RaftLog:
         return self._log
 
     def is_leader(self) -> bool:
         return isinstance(self, Leader)
 
+    def has_lease(self) -> bool:
+        return False
+
     def get_leader_id(self) -> NodeID | None:
         return None
 
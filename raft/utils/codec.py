@@ -0,0 +1,189 @@
+# Wire codec of Maelstrom messages
+
+from __future__ import annotations
+import json
+from types import SimpleNamespace as sn
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional, only used when installed
+    orjson = None
+
+
+class Body:
+    """
+    Slotted message body, fields that a message doesn't carry are None
+    """
+
+    __slots__ = ("type", "msg_id", "in_reply_to")
+    _fields: tuple[str, ...] = __slots__
+
+    def __init__(self, **fields) -> None:
+        for name in self._fields:
+            setattr(self, name, None)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            name: getattr(self, name)
+            for name in self._fields
+            if getattr(self, name) is not None
+        }
+
+
+def body_type(name: str, *fields: str) -> type[Body]:
+    return type(name, (Body,), {"__slots__": fields, "_fields": Body._fields + fields})
+
+
+# Known message types, bodies of any other type are decoded as SimpleNamespace.
+# Log entries are kept as the plain lists they are decoded to, so followers
+# store them without building an object per entry.
+BODY_TYPES: dict[str, type[Body]] = {
+    "append_entries": body_type(
+        "AppendEntries",
+        "term",
+        "leader_id",
+        "prev_log_index",
+        "prev_log_term",
+        "entries",
+        "leader_commit",
+        "read_round",
+        "sent_at",
+    ),
+    "append_entries_response": body_type(
+        "AppendEntriesResponse",
+        "term",
+        "success",
+        "read_round",
+        "sent_at",
+        "entry_count",
+        "last_index",
+        "prev_log_index",
+        "conflict_term",
+        "conflict_index",
+    ),
+    "request_vote": body_type(
+        "RequestVote",
+        "term",
+        "candidate_id",
+        "last_log_index",
+        "last_log_term",
+        "leadership_transfer",
+    ),
+    "request_vote_response": body_type("RequestVoteResponse", "term", "vote_granted"),
+    # Same as request_vote, with the term the candidate would start
+    "pre_vote": body_type(
+        "PreVote", "term", "candidate_id", "last_log_index", "last_log_term"
+    ),
+    "pre_vote_response": body_type("PreVoteResponse", "term", "vote_granted"),
+    "install_snapshot": body_type(
+        "InstallSnapshot",
+        "term",
+        "leader_id",
+        "last_included_index",
+        "last_included_term",
+        "data",
+    ),
+    "install_snapshot_response": body_type(
+        "InstallSnapshotResponse", "term", "last_index"
+    ),
+    # Client ops forwarded by a follower, each with the client it came from,
+    # and the replies relayed back as [client, in_reply_to, body]
+    "forward": body_type("Forward", "term", "ops"),
+    "forward_reply": body_type("ForwardReply", "term", "replies"),
+    # Admin request to hand leadership over to target, or to the most up to
+    # date node, and the leader's order to the target to start an election
+    "transfer_leadership": body_type("TransferLeadership", "target", "shard"),
+    "timeout_now": body_type("TimeoutNow", "term"),
+    # Admin request to add or remove a single voting member
+    "change_membership": body_type("ChangeMembership", "add", "remove", "shard"),
+    # A learner asking the leader for the commit index its reads must wait for
+    "read_index": body_type("ReadIndex", "term", "read_id"),
+    "read_index_response": body_type("ReadIndexResponse", "term", "read_id", "index"),
+    # Messages between the Raft groups of two nodes, sent together
+    "multi": body_type("Multi", "messages"),
+    "quorum_read": body_type("QuorumRead", "key", "client_req_id"),
+    "quorum_read_response": body_type(
+        "QuorumReadResponse",
+        "client_req_id",
+        "timestamp",
+        "data",
+        "has_conflict",
+    ),
+    "leaseholder_read": body_type(
+        "LeaseholderRead", "key", "client_id", "client_req_id", "sent_at"
+    ),
+    "leaseholder_read_response": body_type(
+        "LeaseholderReadResponse",
+        "success",
+        "key",
+        "value",
+        "client_id",
+        "client_req_id",
+        "sent_at",
+        "backlog",
+    ),
+}
+
+
+class Message:
+    __slots__ = ("id", "src", "dest", "body")
+
+    def __init__(self, id: int | None, src: str, dest: str, body) -> None:
+        self.id = id
+        self.src = src
+        self.dest = dest
+        self.body = body
+
+
+def decode_body(body: dict[str, Any]):
+    cls = BODY_TYPES.get(body.get("type"))
+    if cls is not None:
+        try:
+            return cls(**body)
+        except AttributeError:
+            # Field this side doesn't know about, keep every field
+            pass
+    return sn(**body)
+
+
+def encode_default(value: Any) -> Any:
+    if isinstance(value, Body):
+        return value.to_dict()
+    return vars(value)
+
+
+class JsonCodec:
+    """
+    Standard library codec, always available
+    """
+
+    def decode(self, data: str | bytes) -> Message:
+        raw = json.loads(data)
+        return Message(
+            raw.get("id"), raw["src"], raw["dest"], decode_body(raw["body"])
+        )
+
+    def encode(self, message: dict[str, Any]) -> str:
+        return json.dumps(message, default=encode_default)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Faster codec, used when orjson is installed
+    """
+
+    def decode(self, data: str | bytes) -> Message:
+        raw = orjson.loads(data)
+        return Message(
+            raw.get("id"), raw["src"], raw["dest"], decode_body(raw["body"])
+        )
+
+    def encode(self, message: dict[str, Any]) -> str:
+        return orjson.dumps(message, default=encode_default).decode()
+
+
+def default_codec() -> JsonCodec:
+    return OrjsonCodec() if orjson is not None else JsonCodec()
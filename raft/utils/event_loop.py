@@ -0,0 +1,100 @@
+# Single threaded event loop: input lines, timers and self events
+
+import heapq
+import os
+from collections import deque
+from itertools import count
+from selectors import DefaultSelector, EVENT_READ
+from time import monotonic
+from typing import Callable
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        # Left in the heap, skipped once it is due
+        self.cancelled = True
+
+
+class EventLoop:
+    """
+    Runs every callback on the thread that called run, so handlers and timers
+    never race with each other.
+    """
+
+    _ready: deque
+    _timers: list[tuple[float, int, TimerHandle]]
+    _sequence: count
+
+    def __init__(self) -> None:
+        self._ready = deque()
+        self._timers = []
+        self._sequence = count()
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        self._ready.append((callback, args))
+
+    def call_later(self, delay: float, callback: Callable, *args) -> TimerHandle:
+        handle = TimerHandle(monotonic() + delay, callback, args)
+        heapq.heappush(self._timers, (handle.deadline, next(self._sequence), handle))
+        return handle
+
+    def backlog(self) -> int:
+        """
+        Number of callbacks waiting to run, a measure of how loaded the node is
+        """
+        return len(self._ready)
+
+    def run(self, on_line: Callable[[bytes], None], fd: int = 0) -> None:
+        """
+        Call on_line with every line read from fd until it is closed
+        """
+        selector = DefaultSelector()
+        selector.register(fd, EVENT_READ)
+        pending = b""
+
+        while True:
+            self._run_ready()
+            self._run_timers()
+
+            if self._ready:
+                timeout = 0.0
+            elif self._timers:
+                timeout = max(0.0, self._timers[0][0] - monotonic())
+            else:
+                timeout = None
+
+            if selector.select(timeout):
+                data = os.read(fd, 1 << 16)
+                if not data:
+                    break
+                *lines, pending = (pending + data).split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        self.call_soon(on_line, line)
+
+        selector.close()
+
+    def _run_ready(self) -> None:
+        # Callbacks queued while running these wait for the next iteration, so
+        # timers and input are not starved
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def _run_timers(self) -> None:
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self._timers)
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+
+loop = EventLoop()
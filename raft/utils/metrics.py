@@ -0,0 +1,89 @@
+# In-process instrumentation, cheap enough to be always on
+
+import logging
+from json import dumps
+from typing import Any
+
+# Bucket i counts durations below 2^i microseconds, the last one everything else
+BUCKETS = 32
+
+
+class Histogram:
+    __slots__ = ("_count", "_total", "_max", "_buckets")
+
+    def __init__(self) -> None:
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._buckets = [0] * BUCKETS
+
+    def record(self, seconds: float) -> None:
+        self._count += 1
+        self._total += seconds
+        if seconds > self._max:
+            self._max = seconds
+        self._buckets[min(int(seconds * 1_000_000).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Upper bound, in seconds, of the bucket holding the given fraction
+        """
+        target = fraction * self._count
+        seen = 0
+        for bucket, count in enumerate(self._buckets):
+            seen += count
+            if seen >= target:
+                return min((1 << bucket) / 1_000_000, self._max)
+        return self._max
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self._count,
+            "mean": self._total / self._count if self._count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self._max,
+        }
+
+
+class Metrics:
+    """
+    Histograms of durations in seconds, counters and gauges, by name. Only the
+    handler thread records, so no locking is needed.
+    """
+
+    _histograms: dict[str, Histogram]
+    _counters: dict[str, int]
+    _gauges: dict[str, float]
+
+    def __init__(self) -> None:
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name: str, seconds: float) -> None:
+        if (histogram := self._histograms.get(name)) is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def gauge(self, name: str, value: float) -> None:
+        self._gauges[name] = value
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "histograms": {
+                name: histogram.to_dict()
+                for name, histogram in sorted(self._histograms.items())
+            },
+            "counters": dict(sorted(self._counters.items())),
+            "gauges": dict(sorted(self._gauges.items())),
+        }
+
+    def dump(self) -> None:
+        logging.info("metrics %s", dumps(self.snapshot()))
+
+
+metrics = Metrics()
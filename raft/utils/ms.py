@@ -1,31 +1,135 @@
 # Minimal support for Maelstrom node programs
 
+import atexit
 import logging
-from sys import stdin
-from json import loads, dumps
-from types import SimpleNamespace as sn
+from itertools import count
+from queue import SimpleQueue, Empty
+from sys import stdin, stdout
 from os import _exit
+from threading import Thread
+from typing import Callable
+from raft.utils.codec import JsonCodec, Message, decode_body, default_codec
+from raft.utils.event_loop import loop
+
+codec: JsonCodec = default_codec()
+_handler: Callable[[Message], None]
+# Takes every message sent instead of writing it, when set
+_route: Callable[[dict], None] | None = None
+
+
+def set_codec(new_codec: JsonCodec) -> None:
+    global codec
+    codec = new_codec
+
+
+def set_route(route: Callable[[dict], None] | None) -> None:
+    global _route
+    _route = route
+
+
+class Writer:
+    """
+    Writes messages to stdout from a single thread. Messages queued while a
+    write is in progress are written together, with a single flush, and
+    lines of different messages are never interleaved.
+    """
+
+    _queue: SimpleQueue
+    _thread: Thread
+
+    def __init__(self) -> None:
+        self._queue = SimpleQueue()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> None:
+        self._queue.put(line)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while (line := self._queue.get()) is not None:
+            lines = [line]
+            try:
+                while (line := self._queue.get_nowait()) is not None:
+                    lines.append(line)
+            except Empty:
+                pass
+
+            stdout.write("\n".join(lines) + "\n")
+            stdout.flush()
+
+            if line is None:
+                return
+
+
+# next() on a count is atomic, so ids are unique across threads
+_msg_ids = count(1)
+writer = Writer()
+atexit.register(writer.close)
 
-msg_id = 0
 
 def send(src, dest, **body):
-    global msg_id
-    data = dumps(
-        sn(dest=dest, src=src, body=sn(msg_id=(msg_id := msg_id + 1), **body)),
-        default=vars,
-    )
+    message = {"dest": dest, "src": src, "body": {"msg_id": next(_msg_ids), **body}}
+    if _route is not None:
+        _route(message)
+        return
+    write(message)
+
+
+def write(message: dict) -> None:
+    data = codec.encode(message)
     logging.debug("sending %s", data)
-    print(data, flush=True)
+    writer.write(data)
+
+
+def send_all(src, messages: list[tuple[str, dict]]) -> None:
+    """
+    Send (dest, body) messages with a single write
+    """
+    if not messages:
+        return
+    if _route is not None:
+        for dest, body in messages:
+            send(src, dest, **body)
+        return
+    lines = [
+        codec.encode(
+            {"dest": dest, "src": src, "body": {"msg_id": next(_msg_ids), **body}}
+        )
+        for dest, body in messages
+    ]
+    logging.debug("sending %s", lines)
+    writer.write("\n".join(lines))
 
 
 def reply(request, **body):
     send(request.dest, request.src, in_reply_to=request.body.msg_id, **body)
 
 
-def receive_all():
-    while data := stdin.readline():
-        logging.debug("received %s", data.strip())
-        yield loads(data, object_hook=lambda x: sn(**x))
+def post(node_id, **body):
+    """
+    Deliver a message to the node itself, without a round trip through Maelstrom
+    """
+    loop.call_soon(_handler, Message(None, node_id, node_id, decode_body(body)))
+
+
+def run(handler: Callable[[Message], None]) -> None:
+    """
+    Handle every message received on stdin, and the ones posted by the node
+    itself, on the event loop until stdin is closed
+    """
+    global _handler
+    _handler = handler
+
+    def handle_line(line: bytes) -> None:
+        data = line.decode()
+        logging.debug("received %s", data)
+        handler(codec.decode(data))
+
+    loop.run(handle_line, stdin.fileno())
 
 
 def exit_on_error(fn, *args):
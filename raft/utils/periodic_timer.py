@@ -0,0 +1,34 @@
+from math import floor
+from time import monotonic
+from typing import Callable
+from raft.utils.event_loop import loop, TimerHandle
+
+
+class PeriodicTimer:
+    """
+    Ticks fall on multiples of the interval, so timers with the same interval
+    fire together and what they send can be grouped
+    """
+
+    _interval: float
+    _callback: Callable
+    _handle: TimerHandle | None
+
+    def __init__(self, interval: float, callback: Callable):
+        self._interval = interval
+        self._callback = callback
+        self._handle = None
+
+    def start(self):
+        now = monotonic()
+        next_tick = (floor(now / self._interval) + 1) * self._interval
+        self._handle = loop.call_later(next_tick - now, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        self.start()
+        self._callback()
@@ -1,25 +1,47 @@
-from threading import Timer
 from random import uniform
+from time import monotonic
 from typing import Callable
+from raft.utils.event_loop import loop, TimerHandle
 
 
 class RandomTimer:
-    _create_timer: Callable[[], Timer]
-    _timer: Timer
+    _lower: float
+    _upper: float
+    _callback: Callable
+    _args: tuple
+    _kwargs: dict
+    _deadline: float
+    _handle: TimerHandle | None
 
     def __init__(self, lower: int, upper: int, callback, args=None, kwargs=None):
-        self._create_timer = lambda: Timer(
-            uniform(lower, upper), callback, args, kwargs
-        )
-        self._timer = self._create_timer()
+        self._lower = lower
+        self._upper = upper
+        self._callback = callback
+        self._args = args or ()
+        self._kwargs = kwargs or {}
+        self._deadline = 0
+        self._handle = None
 
     def start(self):
-        self._timer.start()
+        self._deadline = monotonic() + uniform(self._lower, self._upper)
+        self._handle = loop.call_later(self._deadline - monotonic(), self._expire)
 
     def reset(self):
-        self._timer.cancel()
-        self._timer = self._create_timer()
-        self._timer.start()
+        # Only moves the deadline, the pending timer reschedules itself when it
+        # fires early, so frequent resets don't create timers
+        self._deadline = monotonic() + uniform(self._lower, self._upper)
+        if self._handle is None:
+            self.start()
 
     def stop(self):
-        self._timer.cancel()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _expire(self):
+        remaining = self._deadline - monotonic()
+        if remaining > 0:
+            self._handle = loop.call_later(remaining, self._expire)
+        else:
+            self._handle = None
+            self._callback(*self._args, **self._kwargs)
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 
+import atexit
 import logging
-from raft.utils.ms import receive_all, reply, exit_on_error
-from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from raft.utils.ms import run, reply, exit_on_error
+from raft.utils.metrics import metrics
 from raft.node.node import Node
 from raft.node.follower import Follower
+from raft.log_storage import open_storage
+from raft.multi_raft import MultiRaft
+from raft.config import SHARDS
 
 
 logging.getLogger().setLevel(logging.DEBUG)
-executor = ThreadPoolExecutor(max_workers=1)
+atexit.register(metrics.dump)
 
-node: Node
+node: Node | MultiRaft
+
+
+def new_node(node_id, node_ids) -> Node:
+    node = Follower(node_id, node_ids)
+    node.recover(open_storage(node_id))
+    return node
 
 
 def handle_init(msg):
@@ -23,7 +34,10 @@ def handle_init(msg):
     node_id = msg.body.node_id
     node_ids = msg.body.node_ids
     node_ids.remove(node_id)
-    node = Follower(node_id, node_ids)
+    if SHARDS > 1:
+        node = MultiRaft(node_id, node_ids, new_node)
+    else:
+        node = new_node(node_id, node_ids)
 
     logging.info("node %s initialized", node_id)
 
@@ -34,8 +48,10 @@ def handle_init(msg):
 
 def handle_rest(msg):
     global node
+    start = perf_counter()
     node = node.handle(msg)
+    metrics.observe("handle." + msg.body.type, perf_counter() - start)
 
 
 handler = handle_init
-executor.map(lambda msg: exit_on_error(handler, msg), receive_all())
+run(lambda msg: exit_on_error(handler, msg))